@@ -3,20 +3,49 @@
 from __future__ import absolute_import
 
 import fnmatch
+import math
+import multiprocessing
 import os
 import random
 
 import numpy
-import numpy.linalg
 from PIL import Image
 
-from mosaicify.colors import average_color
+from mosaicify.colors import (
+    average_color,
+    color_difference,
+    representative_colors,
+)
+from mosaicify.index import KDTreeIndex, VectorIndex
 from mosaicify.output import output_from_matrix
+from mosaicify.pixels import (
+    match_points,
+    pixel_indices,
+)
+from mosaicify.registry import (
+    TileRegistry,
+    as_registry,
+)
 
 
 __version__ = "1.0"
 
 
+# when decoding JPEGs at a reduced scale, keep at least this many decoded pixels
+# for each pixel of the final tile, so thumbnailing still has enough detail to
+# antialias from
+DRAFT_OVERSAMPLE = 2
+
+# the sizes of the chain of thumbnails cached for each source image. Tiles are
+# resampled from the nearest level at least as large, so one chain serves
+# every tile size up to the first level
+MIP_LEVELS = (256, 128, 64, 32)
+
+# representative colors are computed from a thumbnail this large rather than
+# from the tile, so they barely change with the size tiles are rendered at
+COLOR_LEVEL = 64
+
+
 def crop_image(img):
     """Crop the given image square.
 
@@ -29,7 +58,7 @@ def crop_image(img):
         new_width = img.height
         new_height = img.height
 
-        start_x = (img.width - img.height) / 2
+        start_x = (img.width - img.height) // 2
         start_y = 0
 
         img = img.crop((
@@ -43,7 +72,7 @@ def crop_image(img):
         new_height = img.width
 
         start_x = 0
-        start_y = (img.height - img.width) / 2
+        start_y = (img.height - img.width) // 2
 
         img = img.crop((
             start_x,
@@ -55,140 +84,677 @@ def crop_image(img):
     return img
 
 
-def load_sources(path, tile_size, filter, is_color=False, crop=crop_image,
-                 color_method=average_color):
-    """Load the all the source images.
+def find_sources(path, filter):
+    """Find the paths of all the source images.
 
     :param path: The path to the directory containing the source images.
-    :param tile_size: How large each image will appear in the output.
     :param filter: A shell-like glob expression to filter files in the given
         `path` directory. Use `None` to disable filtering.
-    :param is_color: Whether or not to produce a color output (default: False).
-    :param crop: The function that crops the source images square (default:
-        `crop_image`).
-    :param color_method: The function that determines the representative color
-        for a source image (default: `average_color`).
-    :returns: A list of appropriately prepared source images.
+    :returns: A list of paths, in the order they should be loaded. The order
+        is sorted, so it is the same on every file system.
 
     """
 
-    source_images = []
+    paths = []
+
+    for root, dirs, files in os.walk(path):
+        # walked in place, so sorting the directories sorts the walk
+        dirs.sort()
 
-    for root, _, files in os.walk(path):
-        for file in files:
+        for file in sorted(files):
 
             if filter is not None and not fnmatch.fnmatch(file, filter):
                 continue
 
-            image_path = os.path.join(root, file)
+            paths.append(os.path.join(root, file))
+
+    return paths
+
+
+def _load_tiles(paths, tile_size, is_color, crop, color_method, cache):
+    """Load source images, through their mip chains when there is a cache.
+
+    :param paths: The paths of the source images.
+    :param tile_size: How large each image will appear in the output.
+    :param is_color: Whether or not to produce a color output.
+    :param crop: The function that crops the source images square.
+    :param color_method: The function that determines the representative
+        colors, as accepted by `representative_colors`.
+    :param cache: An optional `TileCache` of mip chains.
+    :returns: A list of (image, representative color) tuples, in the same order
+        as `paths`. The representative colors are computed from a thumbnail
+        `COLOR_LEVEL` pixels across, however large the tiles are.
+
+    """
+
+    levels = mip_levels(tile_size)
+    level = nearest_level(levels, tile_size)
+
+    source_images = []
+    color_images = []
+
+    for image_path in paths:
 
-            loaded = load_source(
+        if cache is None:
+            # decoded once, large enough for both the tile and the thumbnail
+            # its color comes from
+            image = _open_source(
                 image_path,
-                tile_size,
-                is_color=is_color,
-                crop=crop,
-                color_method=color_method,
+                max(tile_size, COLOR_LEVEL),
+                is_color,
+                crop,
             )
 
-            source_images.append(loaded)
+            source_image = _shrink(image, tile_size)
+            color_image = _shrink(image, COLOR_LEVEL)
+        else:
+            # COLOR_LEVEL is one of MIP_LEVELS, so it is always in the chain
+            entry = cache.get(
+                image_path,
+                levels,
+                is_color,
+                crop,
+                level,
+                COLOR_LEVEL,
+            )
+
+            if entry is None:
+                chain = prepare_levels(
+                    image_path,
+                    levels,
+                    is_color=is_color,
+                    crop=crop,
+                )
+
+                color_image = chain[levels.index(COLOR_LEVEL)]
+
+                cache.put(image_path, levels, is_color, crop, chain)
+
+                source_image = chain[levels.index(level)]
+            else:
+                source_image, color_image = entry
+
+            source_image = _shrink(source_image, tile_size)
+
+        source_images.append(source_image)
+        color_images.append(color_image)
+
+    colors = representative_colors(color_images, color_method)
+
+    return [
+        (source_image, tuple(rep_color))
+        for source_image, rep_color in zip(source_images, colors.tolist())
+    ]
+
+
+def _load_chunk(task):
+    """Load a chunk of source images in a worker process.
+
+    The loaded images are shipped back to the parent as one buffer of raw
+    pixel data rather than as individually pickled image objects.
+
+    :param task: A tuple of the paths to load followed by the arguments for
+        `_load_tiles`.
+    :returns: A tuple of the image sizes, the representative colors and the
+        concatenated RGB pixel data of the loaded images.
+
+    """
+
+    loaded = _load_tiles(*task)
+
+    sizes = [source_image.size for source_image, _ in loaded]
+    colors = [rep_color for _, rep_color in loaded]
+    data = [source_image.tobytes() for source_image, _ in loaded]
+
+    return (sizes, colors, b"".join(data))
+
+
+def _load_parallel(paths, tile_size, is_color, crop, color_method, jobs,
+                   cache=None, chunk_size=64, pool=None):
+    """Load source images using a pool of worker processes.
+
+    :param paths: The paths of the source images.
+    :param tile_size: How large each image will appear in the output.
+    :param is_color: Whether or not to produce a color output.
+    :param crop: The function that crops the source images square.
+    :param color_method: The function that determines the representative
+        colors, as accepted by `representative_colors`.
+    :param jobs: How many worker processes to use.
+    :param cache: An optional `TileCache` of mip chains, which the workers
+        read from and add to.
+    :param chunk_size: How many images each worker loads per task (default:
+        64).
+    :param pool: An optional `multiprocessing.Pool` to use instead of starting
+        one of `jobs` processes. It is left running.
+    :returns: A list of (image, representative color) tuples, in the same order
+        as `paths`.
+
+    """
+
+    tasks = []
+    for start in range(0, len(paths), chunk_size):
+        tasks.append((
+            paths[start:start + chunk_size],
+            tile_size,
+            is_color,
+            crop,
+            color_method,
+            cache,
+        ))
+
+    source_images = []
+
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(jobs)
+
+    try:
+        # imap yields results in task order, regardless of which worker
+        # finishes first
+        for sizes, colors, data in pool.imap(_load_chunk, tasks):
+
+            offset = 0
+            for size, rep_color in zip(sizes, colors):
+
+                length = size[0] * size[1] * 3
+                source_image = Image.frombytes(
+                    "RGB",
+                    size,
+                    data[offset:offset + length],
+                )
+                offset += length
+
+                source_images.append((source_image, rep_color))
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
 
     return source_images
 
 
-def load_source(path, tile_size, is_color=True, crop=crop_image,
-                color_method=average_color):
-    """Load a single source image.
+def load_paths(paths, tile_size, is_color=False, crop=crop_image,
+               color_method=average_color, jobs=1, cache=None,
+               chunk_size=64, pool=None):
+    """Load the source images at the given paths.
 
-    :param path: The path to the image.
+    :param paths: The paths of the source images.
+    :param tile_size: How large each image will appear in the output.
+    :param is_color: Whether or not to produce a color output (default: False).
+    :param crop: The function that crops the source images square (default:
+        `crop_image`).
+    :param color_method: The function that determines the representative color
+        for a source image (default: `average_color`). The functions in
+        `mosaicify.colors.COLOR_METHODS` are called with a batch of images at
+        a time, see `representative_colors`.
+    :param jobs: How many processes to load images with (default: 1). The
+        `crop` and `color_method` functions must be importable by name when
+        this is more than 1.
+    :param cache: An optional `TileCache`. Images found in it are not decoded
+        again, and newly loaded images are added to it. The cache holds a chain
+        of thumbnails of each image, so it serves every tile size up to the
+        largest of `MIP_LEVELS`.
+    :param chunk_size: How many images are loaded, and have their colors
+        computed, at a time (default: 64).
+    :param pool: An optional `multiprocessing.Pool` to load with, for callers
+        that load several batches of images. It is used instead of `jobs`, and
+        left running.
+    :returns: A list of (image, representative color) tuples, in the same order
+        as `paths`. The representative colors are computed from a
+        `COLOR_LEVEL` thumbnail, so they barely depend on `tile_size`.
+
+    """
+
+    if jobs > 1 or pool is not None:
+        return _load_parallel(
+            paths,
+            tile_size,
+            is_color,
+            crop,
+            color_method,
+            jobs,
+            cache=cache,
+            chunk_size=chunk_size,
+            pool=pool,
+        )
+
+    # a chunk at a time, so only a chunk's color thumbnails are kept around
+    source_images = []
+    for start in range(0, len(paths), chunk_size):
+        source_images.extend(_load_tiles(
+            paths[start:start + chunk_size],
+            tile_size,
+            is_color,
+            crop,
+            color_method,
+            cache,
+        ))
+
+    return source_images
+
+
+def load_registry(path, tile_size, filter, is_color=False, crop=crop_image,
+                  color_method=average_color, jobs=1, cache=None):
+    """Load the all the source images into a tile registry.
+
+    :param path: The path to the directory containing the source images.
+    :param tile_size: How large each image will appear in the output.
+    :param filter: A shell-like glob expression to filter files in the given
+        `path` directory. Use `None` to disable filtering.
+    :param is_color: Whether or not to produce a color output (default: False).
+    :param crop: The function that crops the source images square (default:
+        `crop_image`).
+    :param color_method: The function that determines the representative color
+        for a source image (default: `average_color`).
+    :param jobs: How many processes to load images with (default: 1). The
+        `crop` and `color_method` functions must be importable by name when
+        this is more than 1.
+    :param cache: An optional `TileCache`. Images found in it are not decoded
+        again, and newly loaded images are added to it.
+    :returns: A `TileRegistry` of appropriately prepared source images, with
+        the paths they were loaded from.
+
+    """
+
+    paths = find_sources(path, filter)
+
+    source_images = load_paths(
+        paths,
+        tile_size,
+        is_color=is_color,
+        crop=crop,
+        color_method=color_method,
+        jobs=jobs,
+        cache=cache,
+    )
+
+    return TileRegistry.from_sources(source_images, paths=paths)
+
+
+def load_sources(path, tile_size, filter, is_color=False, crop=crop_image,
+                 color_method=average_color, jobs=1, cache=None):
+    """Load the all the source images.
+
+    :param path: The path to the directory containing the source images.
     :param tile_size: How large each image will appear in the output.
+    :param filter: A shell-like glob expression to filter files in the given
+        `path` directory. Use `None` to disable filtering.
     :param is_color: Whether or not to produce a color output (default: False).
     :param crop: The function that crops the source images square (default:
         `crop_image`).
     :param color_method: The function that determines the representative color
         for a source image (default: `average_color`).
+    :param jobs: How many processes to load images with (default: 1).
+    :param cache: An optional `TileCache` of previously loaded images.
     :returns: A list of appropriately prepared source images.
 
     """
 
+    registry = load_registry(
+        path,
+        tile_size,
+        filter,
+        is_color=is_color,
+        crop=crop,
+        color_method=color_method,
+        jobs=jobs,
+        cache=cache,
+    )
+
+    return registry.sources()
+
+
+def _draft_size(size, tile_size):
+    """Return the smallest size a source image can be decoded at and still
+    cover a cropped tile.
+
+    :param size: The (width, height) of the source image.
+    :param tile_size: How large each image will appear in the output.
+    :returns: A (width, height) tuple to pass to ``Image.draft``.
+
+    """
+
+    width, height = size
+    side = min(width, height)
+
+    # the cropped square must still be at least this large after decoding
+    target = tile_size * DRAFT_OVERSAMPLE
+    if side <= target:
+        return size
+
+    return (
+        int(math.ceil(width * target / float(side))),
+        int(math.ceil(height * target / float(side))),
+    )
+
+
+def _open_source(path, size, is_color, crop, draft=True):
+    """Decode, crop and shrink a source image.
+
+    :param path: The path to the image.
+    :param size: How large the image may be across.
+    :param is_color: Whether or not to keep the image's colors.
+    :param crop: The function that crops the source images square.
+    :param draft: Whether to let formats that support it (JPEG) decode at a
+        reduced scale that still covers `size` (default: True).
+    :returns: An RGB image object, no larger than `size`.
+
+    """
+
     source_image = Image.open(path)
 
+    if draft:
+        # a no-op for formats that can't decode at a reduced scale
+        source_image.draft(None, _draft_size(source_image.size, size))
+
     source_image = crop(source_image)
 
-    source_image.thumbnail((tile_size, tile_size))
+    source_image.thumbnail((size, size))
 
     if not is_color:
         source_image = source_image.convert("L")
 
     # always need to force into RGB only
-    source_image = source_image.convert("RGB")
+    return source_image.convert("RGB")
+
+
+def _shrink(image, size):
+    """Resample an image down to fit a size.
+
+    :param image: An image object.
+    :param size: How large the image may be across.
+    :returns: A new image object, or `image` itself if it already fits.
+
+    """
+
+    width, height = image.size
+
+    scale = size / float(max(width, height))
+    if scale >= 1.0:
+        return image
+
+    return image.resize(
+        (
+            max(1, int(round(width * scale))),
+            max(1, int(round(height * scale))),
+        ),
+        Image.BICUBIC,
+    )
+
+
+def prepare_source(path, tile_size, is_color=True, crop=crop_image,
+                   draft=True):
+    """Load a single source image and prepare it for use as a tile.
+
+    :param path: The path to the image.
+    :param tile_size: How large each image will appear in the output.
+    :param is_color: Whether or not to produce a color output (default: False).
+    :param crop: The function that crops the source images square (default:
+        `crop_image`).
+    :param draft: Whether to let formats that support it (JPEG) decode at a
+        reduced scale that still covers the tile (default: True).
+    :returns: An RGB image object.
+
+    """
+
+    return _open_source(path, tile_size, is_color, crop, draft=draft)
+
+
+def load_source(path, tile_size, is_color=True, crop=crop_image,
+                color_method=average_color, draft=True):
+    """Load a single source image.
+
+    :param path: The path to the image.
+    :param tile_size: How large each image will appear in the output.
+    :param is_color: Whether or not to produce a color output (default: False).
+    :param crop: The function that crops the source images square (default:
+        `crop_image`).
+    :param color_method: The function that determines the representative color
+        for a source image (default: `average_color`).
+    :param draft: Whether to let formats that support it (JPEG) decode at a
+        reduced scale that still covers the tile (default: True).
+    :returns: A tuple of the prepared image and its representative color. The
+        color is computed from a `COLOR_LEVEL` thumbnail, as in `load_paths`.
+
+    """
+
+    image = _open_source(
+        path,
+        max(tile_size, COLOR_LEVEL),
+        is_color,
+        crop,
+        draft=draft,
+    )
+
+    source_image = _shrink(image, tile_size)
 
     (
         representative_r,
         representative_g,
         representative_b,
-    ) = color_method(source_image)
+    ) = color_method(_shrink(image, COLOR_LEVEL))
 
     return (source_image, (representative_r, representative_g, representative_b))
 
 
-def create_mosaic(reference_image, source_images, pixels, tile_size):
-    """Generate the output mosaic image.
+def mip_levels(tile_size):
+    """Return the sizes of the chain of thumbnails that serves a tile size.
+
+    :param tile_size: How large each image will appear in the output.
+    :returns: A tuple of sizes, largest first. This is `MIP_LEVELS`, with
+        levels doubling in size added in front for tiles larger than its first
+        level.
+
+    """
+
+    levels = list(MIP_LEVELS)
+    while levels[0] < tile_size:
+        levels.insert(0, levels[0] * 2)
+
+    return tuple(levels)
+
+
+def prepare_levels(path, levels, is_color=True, crop=crop_image, draft=True):
+    """Load a single source image and prepare a chain of square thumbnails of
+    it, each one resampled from the level before.
+
+    :param path: The path to the image.
+    :param levels: The sizes of the thumbnails, largest first, as returned by
+        `mip_levels`.
+    :param is_color: Whether or not to produce a color output (default: True).
+    :param crop: The function that crops the source images square (default:
+        `crop_image`).
+    :param draft: Whether to let formats that support it (JPEG) decode at a
+        reduced scale that still covers the largest level (default: True).
+    :returns: A list of RGB image objects, one per level. Like
+        `prepare_source`, images are never scaled up, so levels larger than
+        the cropped image hold it at its own size.
+
+    """
+
+    source_image = _open_source(path, levels[0], is_color, crop, draft=draft)
+
+    width, height = source_image.size
+
+    chain = [source_image]
+    for level in levels[1:]:
+        # sized from the first level rather than the one before, so rounding
+        # doesn't build up along the chain
+        scale = min(1.0, level / float(max(width, height)))
+        size = (
+            max(1, int(round(width * scale))),
+            max(1, int(round(height * scale))),
+        )
+
+        source_image = source_image.resize(size, Image.BICUBIC)
+        chain.append(source_image)
+
+    return chain
+
+
+def nearest_level(levels, tile_size):
+    """Return the level of a chain of thumbnails that tiles of a size are
+    resampled from.
+
+    :param levels: The sizes of the thumbnails, as returned by `mip_levels`.
+    :param tile_size: How large each image will appear in the output.
+    :returns: The smallest level at least as large as `tile_size`.
+
+    """
+
+    return min(level for level in levels if level >= tile_size)
+
+
+def create_matrix(reference_image, source_images, pixels,
+                  index_class=None, cells=1, color_space="rgb",
+                  difference="cie76", original_image=None):
+    """Choose the source image for every pixel of the reference image.
 
     :param reference_image: The image that is the source of pixels for the
         output.
-    :param source_images: The list of images as returned by `load_sources` for
-        use as "pixels" of the output image.
-    :param pixels: The list of pixel coordinates representing the order in
-        which pixels will be processed when assembling the output mosaic.
-    :param tile_size: How large each source image will be rendered in the final
-        output.
-    :returns: An image object.
+    :param source_images: The list of images as returned by `load_sources`, or
+        a `TileRegistry`, for use as "pixels" of the output image.
+    :param pixels: The list of pixel coordinates, or array of flat pixel
+        indices, representing the order in which pixels will be processed when
+        assembling the output mosaic.
+    :param index_class: The nearest-color index used to find the closest
+        matching source images. Use `None` for `KDTreeIndex`, or `VectorIndex`
+        with `cells`, whose long descriptors a k-d tree searches slowly
+        (default: None).
+    :param cells: If more than 1, match an N by N grid of colors from each
+        tile against the same grid of the reference, instead of each tile's
+        representative color against a single pixel (default: 1).
+    :param color_space: The color space to match in, "rgb" or "lab"
+        (default: "rgb").
+    :param difference: How colors are compared in the "lab" color space,
+        "cie76" (Euclidean distance) or "ciede2000". CIEDE2000 reorders a
+        shortlist of the nearest tiles by CIE76 (default: "cie76").
+    :param original_image: The full size image the reference was resized
+        from. With `cells`, the reference's grids are taken from it (default:
+        None).
+    :returns: An array of shape ``(height, width)`` of the tile ids chosen for
+        each pixel, as accepted by `output_from_matrix` along with the
+        registry of `source_images`.
 
     """
 
-    pool = source_images[:]
+    if difference == "ciede2000" and color_space != "lab":
+        raise ValueError("the ciede2000 difference needs the lab color space")
+
+    if index_class is None:
+        index_class = VectorIndex if cells > 1 else KDTreeIndex
+
+    registry = as_registry(source_images)
+
+    width = reference_image.width
+
+    tile_points, reference_points = match_points(
+        reference_image,
+        registry,
+        cells=cells,
+        color_space=color_space,
+        original_image=original_image,
+    )
 
-    output_matrix = []
-    for _ in range(reference_image.height):
-        output_matrix.append([None for _ in range(reference_image.width)])
+    # index the representative colors so that the closest matching source
+    # images can be found without comparing against the entire pool. the
+    # index also tracks which tiles remain in the pool.
+    index = index_class(tile_points)
 
-    for x, y in pixels:
+    output_matrix = numpy.full(
+        (reference_image.height, width),
+        -1,
+        dtype=numpy.int32,
+    )
+
+    indices = pixel_indices(pixels, width)
+    reference_colors = reference_points[indices]
+
+    # only chose randomly among the top 20, to avoid too aggressively matching
+    # some source images
+    top = 20
+
+    # the index can only find the nearest by euclidean distance, so find more
+    # than needed and keep those nearest by CIEDE2000
+    shortlist = top
+    if difference == "ciede2000":
+        shortlist = 2 * top
+
+    matches = index.nearest_each(reference_colors, shortlist)
+
+    flat_matrix = output_matrix.reshape(-1)
+
+    for i, nearest in zip(indices.tolist(), matches):
+        top20 = nearest
+        if shortlist > top:
+            distances = color_difference(
+                tile_points[nearest],
+                reference_points[i],
+                difference,
+            )
+            order = numpy.argsort(distances, kind="stable")[:top]
+            top20 = [nearest[j] for j in order.tolist()]
+
+        selected = random.choice(top20)
+
+        # remove the image from the pool, to minimize repetition
+        index.remove(selected)
 
         # pool may become depleted if the number of pixels in the reference
         # image exceeds the number of source images
-        if not pool:
-            pool = source_images[:]
+        if not len(index):
+            index.reset()
 
-        pixel = reference_image.getpixel((x, y))
-        r = pixel[0]
-        g = pixel[1]
-        b = pixel[2]
-        reference_vec = numpy.array([[r, g, b]])
+        flat_matrix[i] = selected
 
-        normed_images = []
-        for image, rep_color in pool:
-            source_vec = numpy.array([rep_color])
+    return output_matrix
 
-            # norm gives us the "distance" or "length" of the vector that is
-            # the difference between the actual pixel color in the image and
-            # the representative color of the source or tile image
-            norm = numpy.linalg.norm(reference_vec - source_vec)
-            normed_images.append((norm, image, rep_color))
 
-        # sort to find the closest matching values
-        normed_images.sort()
+def create_mosaic(reference_image, source_images, pixels, tile_size,
+                  index_class=None, cells=1, color_space="rgb",
+                  difference="cie76", original_image=None):
+    """Generate the output mosaic image.
 
-        # but only chose randomly among the top 20, to avoid too aggressively
-        # matching some source images
-        top20 = normed_images[:20]
-        random.shuffle(top20)
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :param source_images: The list of images as returned by `load_sources`, or
+        a `TileRegistry`, for use as "pixels" of the output image.
+    :param pixels: The list of pixel coordinates, or array of flat pixel
+        indices, representing the order in which pixels will be processed when
+        assembling the output mosaic.
+    :param tile_size: How large each source image will be rendered in the final
+        output.
+    :param index_class: The nearest-color index used to find the closest
+        matching source images, see `create_matrix` (default: None).
+    :param cells: How many cells across each tile is described by, see
+        `create_matrix` (default: 1).
+    :param color_space: The color space to match in, "rgb" or "lab"
+        (default: "rgb").
+    :param difference: How colors are compared in the "lab" color space,
+        "cie76" or "ciede2000" (default: "cie76").
+    :param original_image: The full size image the reference was resized
+        from, see `create_matrix` (default: None).
+    :returns: An image object.
 
-        _, selected_image, rep_color = top20[0]
+    """
 
-        # remove the image from the pool, to minimize repetition
-        pool.remove((selected_image, rep_color))
+    registry = as_registry(source_images)
 
-        output_matrix[y][x] = selected_image
+    output_matrix = create_matrix(
+        reference_image,
+        registry,
+        pixels,
+        index_class=index_class,
+        cells=cells,
+        color_space=color_space,
+        difference=difference,
+        original_image=original_image,
+    )
 
     # generate and return the output image
-    return output_from_matrix(reference_image, tile_size, output_matrix)
+    return output_from_matrix(
+        reference_image,
+        tile_size,
+        output_matrix,
+        registry=registry,
+    )
@@ -0,0 +1,740 @@
+# Copyright 2017, Ryan P. Kelly. All Rights Reserved.
+
+"""
+Optimal placement of tiles by solving the pixel-to-tile assignment problem.
+
+Placing each tile at most once so that the total distance between reference
+pixels and tile colors is as small as possible is a linear assignment problem.
+This solves it with an auction algorithm, restricted to each pixel's nearest
+tiles so that memory and time grow with ``pixels * candidates`` rather than
+``pixels * tiles``. The final prices show whether any pixel could do better
+with a tile outside its candidates, and if so the candidates are widened and
+the problem solved again.
+"""
+
+from __future__ import absolute_import
+
+import random
+import time
+
+import numpy
+
+from mosaicify.colors import color_difference
+from mosaicify.index import VectorIndex
+from mosaicify.output import output_from_matrix
+from mosaicify.pixels import match_points
+from mosaicify.registry import as_registry
+
+
+def _distances(reference, colors, difference):
+    """Return the distances between pairs of reference and tile points.
+
+    :param reference: An array of reference points.
+    :param colors: An array of tile points of the same shape.
+    :param difference: "cie76" for the Euclidean distance, or "ciede2000".
+    :returns: An array of distances.
+
+    """
+
+    if difference == "ciede2000":
+        return color_difference(reference, colors, difference)
+
+    diff = reference - colors
+
+    return numpy.sqrt(numpy.sum(diff * diff, axis=-1))
+
+
+def _nearest_tiles(reference, colors, count, difference="cie76",
+                   block_size=256):
+    """Find the nearest tiles to every reference pixel.
+
+    :param reference: An array of shape ``(pixels, dimensions)`` of reference
+        points.
+    :param colors: An array of shape ``(tiles, dimensions)`` of tile points.
+    :param count: How many tiles to find for each pixel.
+    :param difference: How the distances of the nearest tiles are measured.
+        The tiles themselves are always found by Euclidean distance (default:
+        "cie76").
+    :param block_size: How many pixels to compute distances for at once
+        (default: 256).
+    :returns: A tuple of an array of shape ``(pixels, count)`` of tile ids and
+        an array of the same shape of their distances.
+
+    """
+
+    index = VectorIndex(colors)
+
+    tiles = numpy.empty((len(reference), count), dtype=numpy.intp)
+    distances = numpy.empty((len(reference), count), dtype=numpy.float64)
+
+    for start in range(0, len(reference), block_size):
+        block = index.distances(reference[start:start + block_size])
+
+        if count < block.shape[1]:
+            nearest = numpy.argpartition(block, count - 1, axis=1)[:, :count]
+        else:
+            nearest = numpy.tile(numpy.arange(block.shape[1]), (len(block), 1))
+
+        rows = numpy.arange(len(block))[:, None]
+
+        tiles[start:start + block_size] = nearest
+
+        if difference == "cie76":
+            distances[start:start + block_size] = numpy.sqrt(
+                block[rows, nearest]
+            )
+        else:
+            distances[start:start + block_size] = _distances(
+                reference[start:start + block_size][:, None],
+                colors[nearest],
+                difference,
+            )
+
+    return (tiles, distances)
+
+
+def _segments(starts, members):
+    """Gather the edges of some members of a grouped edge list.
+
+    :param starts: An array where the edges of member ``m`` are
+        ``starts[m]`` up to ``starts[m + 1]``.
+    :param members: The members whose edges to gather.
+    :returns: A tuple of the array of edges, the array of how many each
+        member has, the array of the offset where each member's edges start
+        and the array of which member each edge belongs to, by position in
+        `members`.
+
+    """
+
+    counts = starts[members + 1] - starts[members]
+    offsets = numpy.cumsum(counts) - counts
+
+    segments = numpy.repeat(numpy.arange(len(members)), counts)
+    edges = numpy.repeat(starts[members] - offsets, counts)
+    edges += numpy.arange(len(edges))
+
+    return (edges, counts, offsets, segments)
+
+
+def _best_two(values, counts, offsets, segments):
+    """Find the best and second best value of every segment.
+
+    :param values: An array of values, grouped into segments. It is modified.
+    :param counts: How many values each segment has.
+    :param offsets: Where each segment starts in `values`.
+    :param segments: Which segment each value belongs to.
+    :returns: A tuple of the position of each segment's best value (the
+        first, when there are several), its best value and its second best
+        value. Empty segments have values of minus infinity.
+
+    """
+
+    best = numpy.zeros(len(counts), dtype=numpy.intp)
+    best_value = numpy.full(len(counts), -numpy.inf)
+    second_value = numpy.full(len(counts), -numpy.inf)
+
+    some = numpy.flatnonzero(counts)
+    if not len(some):
+        return (best, best_value, second_value)
+
+    starts = offsets[some]
+
+    best_value[some] = numpy.maximum.reduceat(values, starts)
+
+    tops = numpy.flatnonzero(values == best_value[segments])
+    leading = numpy.ones(len(tops), dtype=bool)
+    leading[1:] = segments[tops[1:]] != segments[tops[:-1]]
+    tops = tops[leading]
+
+    best[segments[tops]] = tops
+
+    values[tops] = -numpy.inf
+    second_value[some] = numpy.maximum.reduceat(values, starts)
+
+    return (best, best_value, second_value)
+
+
+def _alternatives(reference, colors, starts, edge_slots, prices, thresholds,
+                  count, block_size=256):
+    """Find the pixels that would rather have a tile outside their candidates,
+    at the tiles' current prices, and the tiles they would rather have.
+
+    :param reference: An array of shape ``(pixels, dimensions)`` of reference
+        points.
+    :param colors: An array of shape ``(tiles, dimensions)`` of tile points.
+    :param starts: Where each pixel's candidates start in `edge_slots`, as
+        for `_auction`.
+    :param edge_slots: The candidate tiles of all the pixels.
+    :param prices: The price of every tile.
+    :param thresholds: What each pixel pays now, its tile's cost plus price. A
+        pixel wants the tiles whose Euclidean distance plus price is less.
+    :param count: How many tiles to find for each pixel.
+    :param block_size: How many pixels to compute distances for at once
+        (default: 256).
+    :returns: A tuple of an array of the pixels that want other tiles and an
+        array of the same length of the tiles they want, up to `count` of
+        them per pixel.
+
+    """
+
+    index = VectorIndex(colors)
+
+    count = min(count, len(colors))
+
+    wanting = []
+    wanted = []
+
+    for start in range(0, len(reference), block_size):
+        stop = min(start + block_size, len(reference))
+
+        block = numpy.sqrt(index.distances(reference[start:stop]))
+        block += prices
+
+        # a pixel's candidates are already on offer
+        first, last = starts[start], starts[stop]
+        owners = numpy.repeat(
+            numpy.arange(stop - start),
+            numpy.diff(starts[start:stop + 1]),
+        )
+        block[owners, edge_slots[first:last]] = numpy.inf
+
+        want = block.min(axis=1) < thresholds[start:stop]
+        if not want.any():
+            continue
+
+        block = block[want]
+
+        nearest = numpy.argpartition(block, count - 1, axis=1)[:, :count]
+        rows = numpy.arange(len(block))[:, None]
+
+        # a pixel with fewer tiles left than `count` gets what there is
+        usable = numpy.isfinite(block[rows, nearest])
+
+        pixels = numpy.flatnonzero(want) + start
+
+        wanting.append(numpy.broadcast_to(pixels[:, None], usable.shape)[usable])
+        wanted.append(nearest[usable])
+
+    if not wanting:
+        return (
+            numpy.empty(0, dtype=numpy.intp),
+            numpy.empty(0, dtype=numpy.intp),
+        )
+
+    return (numpy.concatenate(wanting), numpy.concatenate(wanted))
+
+
+def _reverse(edge_pixels, edge_slots, values, prices, assigned, columns,
+             epsilon):
+    """Finish an auction when there are more slots than pixels.
+
+    A forward auction leaves slots that were bid on in earlier phases
+    unassigned but still expensive, so pixels avoid them and the result is not
+    optimal. Here each such slot lowers its price and bids for the pixel it
+    is the best deal for, until no unassigned slot costs more than the
+    cheapest assigned one.
+
+    :param edge_pixels: The pixel of every candidate, as for `_auction`.
+    :param edge_slots: The slot of every candidate.
+    :param values: The negated cost of every candidate.
+    :param prices: The price of every slot, which is updated.
+    :param assigned: The slot assigned to every pixel, which is updated.
+    :param columns: The candidate assigned to every pixel, which is updated.
+    :param epsilon: The final epsilon.
+    :returns: The number of bidding rounds.
+
+    """
+
+    slot_count = len(prices)
+
+    # the candidates grouped by slot
+    by_slot = numpy.argsort(edge_slots, kind="stable")
+    slot_pixels = edge_pixels[by_slot]
+    slot_values = values[by_slot]
+
+    starts = numpy.searchsorted(
+        edge_slots[by_slot],
+        numpy.arange(slot_count + 1),
+    )
+
+    profits = values[columns] - prices[assigned]
+
+    owned = numpy.zeros(slot_count, dtype=bool)
+    owned[assigned] = True
+
+    floor = prices[assigned].min()
+
+    bidders = numpy.flatnonzero(~owned & (prices > floor))
+
+    rounds = 0
+
+    while len(bidders):
+        rounds += 1
+
+        # the auction often ends in a long chain of one slot displacing
+        # another, which is much quicker to follow one slot at a time
+        if len(bidders) == 1:
+            slot = bidders[0]
+            first, last = starts[slot], starts[slot + 1]
+
+            gains = slot_values[first:last] - profits[slot_pixels[first:last]]
+
+            if last == first or gains.max() - epsilon <= floor:
+                prices[slot] = floor
+                break
+
+            best = int(numpy.argmax(gains))
+            best_value = gains[best]
+
+            gains[best] = -numpy.inf
+            second_value = gains.max() if last - first > 1 else -numpy.inf
+
+            new_price = max(floor, second_value - epsilon)
+
+            edge = first + best
+            target = slot_pixels[edge]
+
+            released = assigned[target]
+            owned[released] = False
+            owned[slot] = True
+
+            assigned[target] = slot
+            columns[target] = by_slot[edge]
+            profits[target] = slot_values[edge] - new_price
+            prices[slot] = new_price
+
+            if prices[released] <= floor:
+                break
+
+            bidders = numpy.array([released])
+            continue
+
+        edges, counts, offsets, segments = _segments(starts, bidders)
+
+        gains = slot_values[edges] - profits[slot_pixels[edges]]
+
+        # best and second best pixel for every bidding slot
+        best, best_value, second_value = _best_two(
+            gains,
+            counts,
+            offsets,
+            segments,
+        )
+
+        # slots that no pixel wants at the lowest price just become that cheap
+        settled = best_value - epsilon <= floor
+        prices[bidders[settled]] = floor
+
+        active = ~settled
+        slots = bidders[active]
+        best = edges[best[active]]
+
+        new_prices = numpy.maximum(floor, second_value[active] - epsilon)
+        targets = slot_pixels[best]
+        offers = slot_values[best] - new_prices
+
+        # the best offer for each pixel wins
+        ranked = numpy.lexsort((-offers, targets))
+        first = numpy.ones(len(ranked), dtype=bool)
+        first[1:] = targets[ranked[1:]] != targets[ranked[:-1]]
+
+        winning = ranked[first]
+        winners = targets[winning]
+
+        released = assigned[winners]
+        owned[released] = False
+
+        won_slots = slots[winning]
+        owned[won_slots] = True
+        assigned[winners] = won_slots
+        columns[winners] = by_slot[best[winning]]
+        profits[winners] = offers[winning]
+        prices[won_slots] = new_prices[winning]
+
+        losing = numpy.ones(len(slots), dtype=bool)
+        losing[winning] = False
+
+        released = released[prices[released] > floor]
+
+        bidders = numpy.concatenate((slots[losing], released))
+
+    return rounds
+
+
+def _auction(edge_pixels, edge_slots, edge_costs, slot_count, epsilon,
+             scaling=4.0, prices=None, start=None):
+    """Solve a sparse assignment problem with an epsilon-scaled Jacobi auction.
+
+    Every unassigned pixel bids, at once, for its best candidate slot, raising
+    that slot's price by how much better it is than the pixel's second best
+    option plus epsilon. The highest bid for each slot wins, displacing its
+    previous owner. Epsilon starts large, so prices settle quickly, and is
+    reduced until the assignment is within ``pixels * epsilon`` of optimal.
+
+    :param edge_pixels: A sorted array of the pixel of every candidate. Every
+        pixel must have at least one.
+    :param edge_slots: An array of the slot of every candidate. There must be
+        a complete assignment using only these.
+    :param edge_costs: An array of the cost of every candidate.
+    :param slot_count: The number of slots.
+    :param epsilon: The final epsilon.
+    :param scaling: How much epsilon is divided by between phases (default:
+        4).
+    :param prices: Prices to start from, such as those of a previous solve
+        (default: all 0). They are updated.
+    :param start: The epsilon of the first phase (default: a quarter of the
+        largest cost).
+    :returns: A tuple of an array of the slot assigned to each pixel, an
+        array of which candidate that is, the final prices, the number of
+        phases and the number of bidding rounds.
+
+    """
+
+    pixel_count = int(edge_pixels[-1]) + 1
+
+    starts = numpy.searchsorted(edge_pixels, numpy.arange(pixel_count + 1))
+
+    values = -edge_costs
+    largest = float(edge_costs.max())
+
+    if prices is None:
+        prices = numpy.zeros(slot_count)
+
+    if start is None:
+        start = largest / scaling
+
+    current = max(start, epsilon)
+
+    phases = 0
+    rounds = 0
+
+    while True:
+        phases += 1
+
+        # every phase starts from scratch, but keeps the prices from the last
+        owner = numpy.full(slot_count, -1, dtype=numpy.intp)
+        assigned = numpy.full(pixel_count, -1, dtype=numpy.intp)
+        columns = numpy.zeros(pixel_count, dtype=numpy.intp)
+        bidders = numpy.arange(pixel_count)
+
+        while len(bidders):
+            rounds += 1
+
+            edges, counts, offsets, segments = _segments(starts, bidders)
+
+            net = values[edges] - prices[edge_slots[edges]]
+
+            best, best_value, second_value = _best_two(
+                net,
+                counts,
+                offsets,
+                segments,
+            )
+            best = edges[best]
+
+            # with no second choice, bid as if it were the worst option
+            second_value = numpy.where(
+                numpy.isfinite(second_value),
+                second_value,
+                best_value - largest,
+            )
+
+            bid_slots = edge_slots[best]
+            bids = prices[bid_slots] + (best_value - second_value) + current
+
+            # the highest bid for each slot wins
+            order = numpy.lexsort((-bids, bid_slots))
+            sorted_slots = bid_slots[order]
+            first = numpy.ones(len(order), dtype=bool)
+            first[1:] = sorted_slots[1:] != sorted_slots[:-1]
+
+            winning = order[first]
+            won_slots = bid_slots[winning]
+            winners = bidders[winning]
+
+            # previous owners are outbid and have to bid again
+            evicted = owner[won_slots]
+            evicted = evicted[evicted >= 0]
+            assigned[evicted] = -1
+
+            owner[won_slots] = winners
+            assigned[winners] = won_slots
+            columns[winners] = best[winning]
+            prices[won_slots] = bids[winning]
+
+            losing = numpy.ones(len(bidders), dtype=bool)
+            losing[winning] = False
+
+            bidders = numpy.concatenate((bidders[losing], evicted))
+
+        # spare slots left expensive by earlier phases have to be made cheap
+        # again, doing so in every phase keeps the last one short
+        if slot_count > pixel_count:
+            rounds += _reverse(
+                edge_pixels,
+                edge_slots,
+                values,
+                prices,
+                assigned,
+                columns,
+                current,
+            )
+
+        if current <= epsilon:
+            return (assigned, columns, prices, phases, rounds)
+
+        current = max(current / scaling, epsilon)
+
+
+def create_matrix(reference_image, source_images, candidates=16, epsilon=None,
+                  cells=1, color_space="rgb", difference="cie76", stats=None,
+                  original_image=None):
+    """Choose the source image for every pixel of the reference image so that
+    the total distance between pixels and tile colors is minimal, using each
+    tile once.
+
+    Each pixel starts out choosing among its `candidates` nearest tiles. When
+    the tiles' prices in the solution show that some pixels might do better
+    with tiles outside their candidates, those pixels are offered the best
+    such tiles, twice as many as the time before, and the problem is solved
+    again. The result is optimal however contested the nearest tiles are.
+
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :param source_images: The list of images as returned by `load_sources`, or
+        a `TileRegistry`, for use as "pixels" of the output image. There must
+        be at least as many tiles as pixels.
+    :param candidates: How many of the nearest tiles each pixel may be assigned
+        at first (default: 16).
+    :param epsilon: How far from optimal, per pixel, the result may be. The
+        default is ``1 / pixels``, so the total distance is within 1 of the
+        optimum.
+    :param cells: If more than 1, match tile descriptors of N by N cells
+        instead of representative colors, see `mosaicify.create_matrix`
+        (default: 1).
+    :param color_space: The color space to match in, "rgb" or "lab"
+        (default: "rgb").
+    :param difference: How colors are compared in the "lab" color space,
+        "cie76" (Euclidean distance) or "ciede2000". Tiles are always offered
+        by Euclidean distance, so with "ciede2000" only pixels left on their
+        fallback tile are offered more, and the result is optimal among the
+        tiles offered (default: "cie76").
+    :param stats: An optional dictionary, which is filled in with "cost" (the
+        total distance), "elapsed", "phases", "rounds" (bidding rounds),
+        "solves" and "candidates" (the most tiles any pixel was offered).
+    :param original_image: The full size image the reference was resized
+        from, which the descriptors of `cells` are taken from (default: None).
+    :returns: An array of shape ``(height, width)`` of tile ids, as for
+        `mosaicify.create_matrix`.
+    :raises ValueError: If there are fewer tiles than pixels.
+
+    """
+
+    if difference == "ciede2000" and color_space != "lab":
+        raise ValueError("the ciede2000 difference needs the lab color space")
+
+    registry = as_registry(source_images)
+
+    width = reference_image.width
+    height = reference_image.height
+    pixel_count = width * height
+
+    tile_count = len(registry)
+
+    if tile_count < pixel_count:
+        raise ValueError(
+            "the assignment method needs at least as many tiles as pixels, "
+            "got {} tiles for {} pixels".format(tile_count, pixel_count)
+        )
+
+    colors, reference = match_points(
+        reference_image,
+        registry,
+        cells=cells,
+        color_space=color_space,
+        original_image=original_image,
+    )
+
+    if epsilon is None:
+        epsilon = 1.0 / pixel_count
+
+    start = time.time()
+
+    count = min(tile_count, max(1, candidates))
+
+    nearest, distances = _nearest_tiles(
+        reference,
+        colors,
+        count,
+        difference=difference,
+    )
+
+    # give every pixel one more, randomly chosen, distinct tile. these form a
+    # complete assignment on their own, so the restricted problem always has a
+    # solution even when the nearest tiles are contested.
+    rng = numpy.random.default_rng(random.getrandbits(64))
+    fallback = rng.permutation(tile_count)[:pixel_count]
+
+    # don't offer the same tile twice
+    fresh = ~(nearest == fallback[:, None]).any(axis=1)
+
+    pixels = numpy.arange(pixel_count)
+
+    edge_pixels = numpy.concatenate((
+        numpy.repeat(pixels, count),
+        pixels[fresh],
+    ))
+    edge_slots = numpy.concatenate((nearest.ravel(), fallback[fresh]))
+    edge_costs = numpy.concatenate((
+        distances.ravel(),
+        _distances(reference[fresh], colors[fallback[fresh]], difference),
+    ))
+    edge_fallback = numpy.zeros(len(edge_pixels), dtype=bool)
+    edge_fallback[count * pixel_count:] = True
+
+    phases = 0
+    rounds = 0
+    solves = 0
+
+    prices = None
+    resume = None
+
+    while True:
+        solves += 1
+
+        order = numpy.argsort(edge_pixels, kind="stable")
+        edge_pixels = edge_pixels[order]
+        edge_slots = edge_slots[order]
+        edge_costs = edge_costs[order]
+        edge_fallback = edge_fallback[order]
+
+        placement, columns, prices, solve_phases, solve_rounds = _auction(
+            edge_pixels,
+            edge_slots,
+            edge_costs,
+            tile_count,
+            epsilon,
+            prices=prices,
+            start=resume,
+        )
+
+        phases += solve_phases
+        rounds += solve_rounds
+
+        if difference == "cie76":
+            # the auction leaves no pixel wanting another of its candidates by
+            # more than epsilon. when no pixel wants a tile outside them
+            # either, the assignment is within pixels * epsilon of optimal.
+            thresholds = edge_costs[columns] + prices[placement] - epsilon
+        else:
+            # tiles are found by Euclidean distance, which says nothing about
+            # their ciede2000 distance, so only the pixels left on their
+            # fallback tile look for others
+            thresholds = numpy.where(
+                edge_fallback[columns],
+                numpy.inf,
+                -numpy.inf,
+            )
+
+        wanting, wanted = _alternatives(
+            reference,
+            colors,
+            numpy.searchsorted(edge_pixels, numpy.arange(pixel_count + 1)),
+            edge_slots,
+            prices,
+            thresholds,
+            count,
+        )
+
+        if not len(wanting):
+            break
+
+        count *= 2
+
+        # when only a few candidates are added, the prices are nearly right
+        # already and a low epsilon finishes quickly. otherwise start over.
+        if len(wanting) * 20 < len(edge_pixels):
+            resume = epsilon * 16
+        else:
+            prices = None
+            resume = None
+
+        edge_pixels = numpy.concatenate((edge_pixels, wanting))
+        edge_slots = numpy.concatenate((edge_slots, wanted))
+        edge_costs = numpy.concatenate((
+            edge_costs,
+            _distances(reference[wanting], colors[wanted], difference),
+        ))
+        edge_fallback = numpy.concatenate((
+            edge_fallback,
+            numpy.zeros(len(wanting), dtype=bool),
+        ))
+
+    elapsed = time.time() - start
+
+    if stats is not None:
+        distances = _distances(reference, colors[placement], difference)
+
+        stats.update({
+            "cost": float(distances.sum()),
+            "elapsed": elapsed,
+            "phases": phases,
+            "rounds": rounds,
+            "solves": solves,
+            "candidates": int(numpy.bincount(edge_pixels).max()),
+        })
+
+    return placement.reshape((height, width)).astype(numpy.int32)
+
+
+def create_mosaic(reference_image, source_images, tile_size, candidates=16,
+                  epsilon=None, cells=1, color_space="rgb", difference="cie76",
+                  stats=None, original_image=None):
+    """Generate the output mosaic image with the placement that minimizes the
+    total distance between pixels and tile colors.
+
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :param source_images: The list of images as returned by `load_sources`, or
+        a `TileRegistry`, for use as "pixels" of the output image.
+    :param tile_size: How large each source image will be rendered in the final
+        output.
+    :param candidates: How many of the nearest tiles each pixel may be assigned
+        at first (default: 16).
+    :param epsilon: How far from optimal, per pixel, the result may be
+        (default: ``1 / pixels``).
+    :param cells: How many cells across each tile is described by (default:
+        1).
+    :param color_space: The color space to match in, "rgb" or "lab"
+        (default: "rgb").
+    :param difference: How colors are compared in the "lab" color space,
+        "cie76" or "ciede2000" (default: "cie76").
+    :param stats: An optional dictionary, which is filled in as described in
+        `create_matrix`.
+    :param original_image: The full size image the reference was resized
+        from, see `create_matrix` (default: None).
+    :returns: An image object.
+
+    """
+
+    registry = as_registry(source_images)
+
+    output_matrix = create_matrix(
+        reference_image,
+        registry,
+        candidates=candidates,
+        epsilon=epsilon,
+        cells=cells,
+        color_space=color_space,
+        difference=difference,
+        stats=stats,
+        original_image=original_image,
+    )
+
+    # create and return output
+    return output_from_matrix(
+        reference_image,
+        tile_size,
+        output_matrix,
+        registry=registry,
+    )
@@ -0,0 +1,293 @@
+# Copyright 2017, Ryan P. Kelly. All Rights Reserved.
+
+"""
+Compact, memory-mapped storage for whole libraries of source images.
+
+An atlas is a directory holding every tile's pixels in a single array of shape
+``(n_tiles, tile_size, tile_size, 3)``, the representative colors in a second
+array and the source paths in a JSON index. Loading an atlas maps the pixel
+array instead of reading it, so tiles are only paged in when they are used.
+"""
+
+from __future__ import absolute_import
+
+import json
+import multiprocessing
+import os
+
+import numpy
+import numpy.lib.format
+from PIL import Image
+
+from mosaicify import (
+    crop_image,
+    load_paths,
+)
+from mosaicify.colors import (
+    COLOR_METHODS,
+    average_color,
+)
+from mosaicify.registry import TileRegistry
+
+
+PIXELS_FILE = "pixels.npy"
+COLORS_FILE = "colors.npy"
+INDEX_FILE = "index.json"
+
+
+class TileAtlas(TileRegistry):
+    """A tile registry backed by arrays rather than image objects."""
+
+    def __init__(self, pixels, colors, paths=None, is_color=None,
+                 color_method=None):
+        """Create the atlas.
+
+        :param pixels: An array of shape ``(n_tiles, tile_size, tile_size, 3)``
+            of RGB pixels, usually a `numpy.memmap`.
+        :param colors: An array of shape ``(n_tiles, 3)`` of representative
+            colors.
+        :param paths: An optional list of the paths the tiles were loaded from.
+        :param is_color: Whether the tiles were loaded in color, or `None` if
+            it is not known.
+        :param color_method: The name of the method the representative colors
+            were chosen with, or `None` if it is not known.
+
+        """
+
+        if len(pixels) != len(colors):
+            raise ValueError("got {} tiles but {} colors".format(
+                len(pixels),
+                len(colors),
+            ))
+
+        if paths is not None and len(paths) != len(pixels):
+            raise ValueError("got {} tiles but {} paths".format(
+                len(pixels),
+                len(paths),
+            ))
+
+        self.pixels = pixels
+        self.colors = numpy.asarray(colors)
+        self.paths = list(paths) if paths is not None else None
+        self.is_color = is_color
+        self.color_method = color_method
+
+        self._descriptors = {}
+
+    @property
+    def tile_size(self):
+        """The width and height of every tile, in pixels."""
+
+        return self.pixels.shape[1]
+
+    def __len__(self):
+        """Return the number of tiles."""
+
+        return len(self.pixels)
+
+    def image(self, tile_id):
+        """Return the image for a tile.
+
+        :param tile_id: The tile id.
+        :returns: An image object, holding a copy of the tile's pixels.
+
+        """
+
+        return Image.fromarray(numpy.asarray(self.pixels[tile_id]), "RGB")
+
+    def tile(self, tile_id):
+        """Return the pixels of a tile.
+
+        :param tile_id: The tile id.
+        :returns: A view of the tile's pixels in the atlas.
+
+        """
+
+        return self.pixels[tile_id]
+
+    def _compute_descriptors(self, cells, chunk_size=1024):
+        """Compute the descriptor of every tile, see `descriptors`.
+
+        When the cells evenly divide the tiles, they are averaged straight
+        from the pixel array, a chunk of tiles at a time.
+
+        :param cells: How many cells across each descriptor is.
+        :param chunk_size: How many tiles to average at once (default: 1024).
+        :returns: An array of shape ``(tiles, cells * cells * 3)``.
+
+        """
+
+        tile_size = self.tile_size
+        if tile_size % cells:
+            return super(TileAtlas, self)._compute_descriptors(cells)
+
+        step = tile_size // cells
+        area = step * step
+
+        descriptors = numpy.empty(
+            (len(self), cells * cells * 3),
+            dtype=numpy.int64,
+        )
+
+        for start in range(0, len(self), chunk_size):
+            chunk = numpy.asarray(self.pixels[start:start + chunk_size])
+            chunk = chunk.reshape((len(chunk), cells, step, cells, step, 3))
+
+            totals = chunk.sum(axis=(2, 4), dtype=numpy.int64)
+
+            # rounded, as when resizing an image with a box filter
+            descriptors[start:start + len(chunk)] = (
+                (totals + area // 2) // area
+            ).reshape((len(chunk), -1))
+
+        return descriptors
+
+
+def is_atlas(path):
+    """Return whether a path is an atlas directory.
+
+    :param path: A path.
+    :returns: True if `path` contains an atlas.
+
+    """
+
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+def color_method_name(color_method):
+    """Return the name an atlas records for a color method.
+
+    :param color_method: A function that determines representative colors.
+    :returns: Its name in `COLOR_METHODS`, or else the function's own name.
+
+    """
+
+    for name, method in COLOR_METHODS.items():
+        if method is color_method:
+            return name
+
+    return getattr(color_method, "__name__", repr(color_method))
+
+
+def build_atlas(directory, paths, tile_size, is_color=False, crop=crop_image,
+                color_method=average_color, jobs=1, cache=None,
+                chunk_size=1024):
+    """Load source images and write them to a new atlas.
+
+    Images are loaded and written a chunk at a time, so the whole library never
+    has to be in memory at once.
+
+    :param directory: The directory to write the atlas to.
+    :param paths: The paths of the source images.
+    :param tile_size: How large each image will appear in the output.
+    :param is_color: Whether or not to produce a color output (default: False).
+    :param crop: The function that crops the source images square (default:
+        `crop_image`).
+    :param color_method: The function that determines the representative color
+        for a source image (default: `average_color`).
+    :param jobs: How many processes to load images with (default: 1).
+    :param cache: An optional `TileCache` of previously loaded images.
+    :param chunk_size: How many images to load at a time (default: 1024).
+    :returns: The new atlas, loaded with `load_atlas`.
+
+    """
+
+    if not paths:
+        raise ValueError("an atlas needs at least one source image")
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    index_path = os.path.join(directory, INDEX_FILE)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
+    pixels = numpy.lib.format.open_memmap(
+        os.path.join(directory, PIXELS_FILE),
+        mode="w+",
+        dtype=numpy.uint8,
+        shape=(len(paths), tile_size, tile_size, 3),
+    )
+
+    colors = []
+
+    # one pool serves every chunk, rather than starting one per chunk
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+
+    try:
+        for start in range(0, len(paths), chunk_size):
+
+            loaded = load_paths(
+                paths[start:start + chunk_size],
+                tile_size,
+                is_color=is_color,
+                crop=crop,
+                color_method=color_method,
+                jobs=jobs,
+                cache=cache,
+                pool=pool,
+            )
+
+            for offset, (source_image, rep_color) in enumerate(loaded):
+
+                # every tile in an atlas has the same shape, so sources
+                # smaller than the tile size are scaled up to fit
+                if source_image.size != (tile_size, tile_size):
+                    source_image = source_image.resize((tile_size, tile_size))
+
+                pixels[start + offset] = numpy.asarray(source_image)
+                colors.append(rep_color)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    pixels.flush()
+    del pixels
+
+    numpy.save(
+        os.path.join(directory, COLORS_FILE),
+        numpy.array(colors, dtype=numpy.int64).reshape((len(paths), -1)),
+    )
+
+    # the index is written last, so an interrupted build is not mistaken for an
+    # atlas by `is_atlas`
+    with open(index_path, "w") as fp:
+        json.dump(
+            {
+                "tile_size": tile_size,
+                "is_color": bool(is_color),
+                "color_method": color_method_name(color_method),
+                "paths": list(paths),
+            },
+            fp,
+        )
+
+    return load_atlas(directory)
+
+
+def load_atlas(directory):
+    """Load an atlas written by `build_atlas`.
+
+    :param directory: The atlas directory.
+    :returns: A `TileAtlas` whose pixels are memory-mapped read-only. Atlases
+        built before `is_color` and `color_method` were recorded have them as
+        `None`.
+
+    """
+
+    with open(os.path.join(directory, INDEX_FILE)) as fp:
+        index = json.load(fp)
+
+    pixels = numpy.load(os.path.join(directory, PIXELS_FILE), mmap_mode="r")
+    colors = numpy.load(os.path.join(directory, COLORS_FILE))
+
+    return TileAtlas(
+        pixels,
+        colors,
+        paths=index["paths"],
+        is_color=index.get("is_color"),
+        color_method=index.get("color_method"),
+    )
@@ -0,0 +1,169 @@
+# Copyright 2017, Ryan P. Kelly. All Rights Reserved.
+
+"""
+Persistent on-disk cache of prepared source images.
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import os
+import tempfile
+import zipfile
+
+import numpy
+from PIL import Image
+
+
+def _function_name(f):
+    """Return a stable name for a function, for use in cache keys.
+
+    :param f: A function.
+    :returns: The qualified name of the function.
+
+    """
+
+    return "{}.{}".format(
+        getattr(f, "__module__", None),
+        getattr(f, "__name__", repr(f)),
+    )
+
+
+class TileCache(object):
+    """A directory of prepared source images.
+
+    Each entry holds a chain of thumbnails of one source image, as prepared by
+    `mosaicify.prepare_levels`, so a single entry serves every tile size that
+    the chain covers, as well as the thumbnail representative colors are
+    computed from, which is one of its levels. The colors themselves are not
+    cached; they are cheap to compute again, which keeps entries independent
+    of the color method. Entries are compressed.
+
+    Entries are keyed by the source file's path, size and modification time and
+    by every parameter that affects how it is prepared, so a changed file
+    simply misses the cache.
+
+    """
+
+    def __init__(self, directory):
+        """Open the cache, creating its directory if needed.
+
+        :param directory: The directory the cache is stored in.
+
+        """
+
+        self.directory = directory
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, path, levels, is_color, crop):
+        """Return the cache key for a source image.
+
+        :param path: The path to the image.
+        :param levels: The sizes of the chain of thumbnails, largest first.
+        :param is_color: Whether or not to produce a color output.
+        :param crop: The function that crops the source images square.
+        :returns: A hex digest identifying the prepared image.
+
+        """
+
+        stat = os.stat(path)
+        mtime = getattr(stat, "st_mtime_ns", stat.st_mtime)
+
+        parts = (
+            os.path.abspath(path),
+            stat.st_size,
+            mtime,
+            tuple(levels),
+            bool(is_color),
+            _function_name(crop),
+        )
+
+        return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key):
+        """Return the path of the file holding a cache entry.
+
+        :param key: The cache key.
+        :returns: A path inside the cache directory.
+
+        """
+
+        # fan out over subdirectories to keep directories a reasonable size
+        return os.path.join(self.directory, key[:2], key + ".npz")
+
+    def get(self, path, levels, is_color, crop, level, color_level):
+        """Return two levels of the cached thumbnails of a source image.
+
+        :param path: The path to the image.
+        :param levels: The sizes of the chain of thumbnails, largest first.
+        :param is_color: Whether or not to produce a color output.
+        :param crop: The function that crops the source images square.
+        :param level: The level to return, one of `levels`.
+        :param color_level: The level representative colors are computed from,
+            one of `levels`. Only these two levels are read from the entry.
+        :returns: A tuple of the image objects at `level` and at
+            `color_level`, or `None` if the image is not cached.
+
+        """
+
+        key = self.key(path, levels, is_color, crop)
+        entry_path = self._entry_path(key)
+
+        if not os.path.exists(entry_path):
+            return None
+
+        try:
+            with numpy.load(entry_path) as entry:
+                level_pixels = entry["level_{}".format(level)]
+                color_pixels = entry["level_{}".format(color_level)]
+        except (IOError, OSError, ValueError, KeyError, zipfile.BadZipfile):
+            # a damaged entry is treated as a miss and rewritten
+            return None
+
+        return (
+            Image.fromarray(level_pixels, "RGB"),
+            Image.fromarray(color_pixels, "RGB"),
+        )
+
+    def put(self, path, levels, is_color, crop, chain):
+        """Store the thumbnails of a source image.
+
+        :param path: The path to the image.
+        :param levels: The sizes of the chain of thumbnails, largest first.
+        :param is_color: Whether or not to produce a color output.
+        :param crop: The function that crops the source images square.
+        :param chain: The list of image objects returned by
+            `mosaicify.prepare_levels`.
+
+        """
+
+        key = self.key(path, levels, is_color, crop)
+        entry_path = self._entry_path(key)
+
+        entry_directory = os.path.dirname(entry_path)
+        if not os.path.isdir(entry_directory):
+            try:
+                os.makedirs(entry_directory)
+            except OSError:
+                # another process may have created it in the meantime
+                if not os.path.isdir(entry_directory):
+                    raise
+
+        arrays = {}
+        for level, source_image in zip(levels, chain):
+            arrays["level_{}".format(level)] = numpy.asarray(
+                source_image.convert("RGB"),
+            )
+
+        # write to a temporary file and rename it into place, so readers never
+        # see a partially written entry
+        fd, temp_path = tempfile.mkstemp(dir=entry_directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                numpy.savez_compressed(fp, **arrays)
+            os.rename(temp_path, entry_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
@@ -6,67 +6,536 @@ Color-related functions.
 
 from __future__ import absolute_import
 
-import math
+import numpy
+
+
+# the CIE standard illuminant D65 white point, in XYZ
+_WHITE = numpy.array([0.95047, 1.0, 1.08883])
+
+# linear sRGB to XYZ, with each row divided by the white point so that the
+# result is already relative to it
+_RGB_TO_XYZ = numpy.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+]) / _WHITE[:, None]
+
+COLOR_SPACES = ("rgb", "lab")
+COLOR_DIFFERENCES = ("cie76", "ciede2000")
+
+
+def _linearize(values):
+    """Undo the sRGB transfer function.
+
+    :param values: An array of channel values from 0 to 255.
+    :returns: An array of linear values from 0 to 1.
+
+    """
+
+    values = numpy.asarray(values, dtype=numpy.float64) / 255.0
+
+    return numpy.where(
+        values <= 0.04045,
+        values / 12.92,
+        ((values + 0.055) / 1.055) ** 2.4,
+    )
+
+
+# channel values are almost always 8-bit, so they're linearized by table lookup
+_LINEAR = _linearize(numpy.arange(256))
+
+
+def _tile_array(image):
+    """Return the RGB pixels of one image as an array of shape
+    ``(pixels, 3)``.
+
+    :param image: An image object or an array of RGB pixels.
+    :returns: An array of shape ``(pixels, 3)``.
+
+    """
+
+    if not isinstance(image, numpy.ndarray):
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        image = numpy.asarray(image)
+
+    return image.reshape((-1, 3))
+
+
+def _stacks(images):
+    """Gather the RGB pixels of one or more images into stacks of equally
+    sized images, so that each image's pixels lie along their own axis.
+
+    :param images: An image object, an array of shape ``(height, width, 3)``,
+        an array of shape ``(n, height, width, 3)`` or a list of image
+        objects and arrays.
+    :returns: A tuple of a list of arrays of shape ``(images, pixels, 3)``,
+        holding the images in order, and whether a batch was given.
+
+    """
+
+    if isinstance(images, numpy.ndarray) and images.ndim == 4:
+        return ([images.reshape((len(images), -1, 3))], True)
+
+    if not isinstance(images, (list, tuple)):
+        return ([_tile_array(images)[None]], False)
+
+    arrays = [_tile_array(image) for image in images]
+
+    if len(set(array.shape for array in arrays)) == 1:
+        return ([numpy.stack(arrays)], True)
+
+    # images of different sizes are handled one at a time
+    return ([array[None] for array in arrays], True)
+
+
+def _batch_color(color_method, img, *args):
+    """Apply a function computing the colors of a stack of images to an image
+    or a batch of them.
+
+    :param color_method: A function taking an array of shape ``(images,
+        pixels, 3)`` and returning an array of shape ``(images, 3)``.
+    :param img: The image or batch of images, as accepted by `_stacks`.
+    :param args: Further arguments for `color_method`.
+    :returns: A three-tuple, or for a batch an array of shape ``(n, 3)``.
+
+    """
+
+    stacks, batch = _stacks(img)
+
+    colors = [color_method(stack, *args) for stack in stacks]
+    if colors:
+        colors = numpy.concatenate(colors).astype(numpy.int64)
+    else:
+        colors = numpy.zeros((0, 3), dtype=numpy.int64)
+
+    if not batch:
+        r, g, b = colors[0].tolist()
+        return (r, g, b)
+
+    return colors
+
+
+def _average(stack):
+    """Return the average color of each of a stack of images, rounded down.
+
+    :param stack: An array of shape ``(images, pixels, 3)``.
+    :returns: An array of shape ``(images, 3)``.
+
+    """
+
+    return stack.sum(axis=1, dtype=numpy.int64) // stack.shape[1]
 
 
 def average_color(img):
-    """Return the average color of the given image.
+    """Return the average color of the given image, or of each of a batch of
+    images.
+
+    Each channel of the average is rounded down.
 
-    :param img: An image object.
-    :returns: A three-tuple representing the average color.
+    :param img: An image object, an array of RGB pixels, or a batch of them as
+        a list or an array of shape ``(n, height, width, 3)``.
+    :returns: A three-tuple representing the average color, or for a batch an
+        array of shape ``(n, 3)``.
 
     """
 
-    h = img.histogram()
+    return _batch_color(_average, img)
+
 
-    # split into red, green, blue
-    r = h[0:256]
-    g = h[256:512]
-    b = h[512:768]
+def _commonest(stack):
+    """Return the most common color of each of a stack of images.
 
-    def wavg(s):
-        """Find the weighted average of the sequence, which is a color channel.
+    :param stack: An array of shape ``(images, pixels, 3)``.
+    :returns: An array of shape ``(images, 3)``.
+
+    """
 
-        :param s: A color channel sequence.
-        :returns: The weighted average.
+    # pack each color into 24 bits, which also orders them like tuples
+    pixels = stack.astype(numpy.uint32)
+    packed = (pixels[..., 0] << 16) | (pixels[..., 1] << 8) | pixels[..., 2]
+    packed.sort(axis=1)
 
-        """
+    # the start of each run of one color, and of every image
+    first = numpy.ones(packed.shape, dtype=bool)
+    first[:, 1:] = packed[:, 1:] != packed[:, :-1]
+    starts = numpy.flatnonzero(first)
 
-        # i is the index which is the channel value. w is the weight which is
-        # the frequency of occurence.
-        weighted = sum(i*w for i, w in enumerate(s))
+    size = packed.shape[1]
+    values = packed.ravel()[starts].astype(numpy.int64)
+    counts = numpy.diff(numpy.append(starts, packed.size))
 
-        # sum of all values, which is how many times they occur
-        total = sum(s)
+    # runs are in image order, starting at the start of each image
+    image_starts = numpy.searchsorted(starts, numpy.arange(len(packed)) * size)
 
-        return int(weighted / float(total))
+    # per image, the run of the largest count and then the largest color
+    keys = (counts << 24) | values
+    winners = numpy.maximum.reduceat(keys, image_starts) & 0xFFFFFF
 
-    return (wavg(r), wavg(g), wavg(b))
+    return numpy.stack(
+        [winners >> 16, (winners >> 8) & 0xFF, winners & 0xFF],
+        axis=1,
+    )
 
 
 def commonest_color(img):
-    """Return the most common color of the given image.
+    """Return the most common color of the given image, or of each of a batch
+    of images.
+
+    Of equally common colors, the one with the largest (r, g, b) tuple wins.
+
+    :param img: An image object, an array of RGB pixels, or a batch of them as
+        a list or an array of shape ``(n, height, width, 3)``.
+    :returns: A three-tuple representing the commonest color, or for a batch
+        an array of shape ``(n, 3)``.
+
+    """
+
+    return _batch_color(_commonest, img)
+
+
+def _median(stack):
+    """Return the median of each channel of each of a stack of images.
+
+    :param stack: An array of shape ``(images, pixels, 3)``.
+    :returns: An array of shape ``(images, 3)``.
+
+    """
+
+    size = stack.shape[1]
+    low = (size - 1) // 2
+    high = size // 2
+
+    ordered = numpy.partition(stack, (low, high), axis=1)
+
+    return (ordered[:, low].astype(numpy.int64) + ordered[:, high]) // 2
+
+
+def median_color(img):
+    """Return the median of each channel of the given image, or of each of a
+    batch of images.
+
+    With an even number of pixels, the two middle values are averaged and
+    rounded down.
+
+    :param img: An image object, an array of RGB pixels, or a batch of them as
+        a list or an array of shape ``(n, height, width, 3)``.
+    :returns: A three-tuple representing the median color, or for a batch an
+        array of shape ``(n, 3)``.
+
+    """
+
+    return _batch_color(_median, img)
+
+
+def _dominant(stack, clusters, iterations):
+    """Return the center of the largest cluster of colors in each of a stack
+    of images, rounded down.
+
+    :param stack: An array of shape ``(images, pixels, 3)``.
+    :param clusters: How many clusters to look for.
+    :param iterations: How many rounds of k-means to run.
+    :returns: An array of shape ``(images, 3)``.
+
+    """
+
+    pixels = stack.astype(numpy.float64)
+    count, size = pixels.shape[:2]
+
+    # start from the pixels at evenly spaced ranks of luminance
+    luminance = numpy.dot(pixels, [0.299, 0.587, 0.114])
+    order = numpy.argsort(luminance, axis=1, kind="stable")
+
+    ranks = ((numpy.arange(clusters) + 0.5) / clusters * size).astype(
+        numpy.intp,
+    )
+    picks = order[:, ranks]
+    centers = numpy.take_along_axis(pixels, picks[:, :, None], axis=1)
+
+    distances = numpy.empty((count, size, clusters))
+    members = numpy.zeros((count, clusters))
+
+    for _ in range(iterations):
 
-    :param img: An image object.
-    :returns: A three-tuple representing the commonest color.
+        # one cluster at a time, so only one difference array is needed
+        for cluster in range(clusters):
+            diff = pixels - centers[:, cluster, None, :]
+            distances[:, :, cluster] = numpy.einsum("ijk,ijk->ij", diff, diff)
+
+        labels = numpy.argmin(distances, axis=2)
+
+        for cluster in range(clusters):
+            mask = labels == cluster
+            members[:, cluster] = mask.sum(axis=1)
+
+            totals = numpy.einsum("ij,ijk->ik", mask.astype(float), pixels)
+
+            # empty clusters keep their center
+            filled = members[:, cluster] > 0
+            centers[filled, cluster] = (
+                totals[filled] / members[filled, cluster, None]
+            )
+
+    largest = numpy.argmax(members, axis=1)
+
+    return numpy.floor(centers[numpy.arange(count), largest])
+
+
+def dominant_color(img, clusters=4, iterations=8):
+    """Return the center of the largest cluster of colors in the given image,
+    or in each of a batch of images.
+
+    The pixels of each image are grouped into `clusters` clusters with
+    k-means, starting from colors spread evenly through the image's range of
+    luminance. Unlike the average, this ignores small areas of very different
+    colors.
+
+    :param img: An image object, an array of RGB pixels, or a batch of them as
+        a list or an array of shape ``(n, height, width, 3)``.
+    :param clusters: How many clusters to look for (default: 4).
+    :param iterations: How many rounds of k-means to run (default: 8).
+    :returns: A three-tuple representing the dominant color, rounded down, or
+        for a batch an array of shape ``(n, 3)``.
+
+    """
+
+    return _batch_color(_dominant, img, clusters, iterations)
+
+
+COLOR_METHODS = {
+    "average": average_color,
+    "commonest": commonest_color,
+    "median": median_color,
+    "dominant": dominant_color,
+}
+
+
+def representative_colors(tiles, method="average", chunk_size=256):
+    """Return the representative color of each of a batch of tiles.
+
+    The tiles are handed to `method` a chunk at a time, so that the memory it
+    needs stays bounded however many tiles there are.
+
+    :param tiles: An array of shape ``(n, height, width, 3)`` of RGB pixels,
+        or a list of image objects or arrays.
+    :param method: The name of one of `COLOR_METHODS`, or a function. The
+        functions in `COLOR_METHODS`, and any function with a true ``batch``
+        attribute, are called with a batch of tiles and return one color per
+        tile. Any other function is called with one tile at a time and
+        returns its color, as `mosaicify.load_source` calls it (default:
+        "average").
+    :param chunk_size: How many tiles to compute colors for at once (default:
+        256).
+    :returns: An array of shape ``(n, 3)``.
+
+    """
+
+    if not callable(method):
+        try:
+            method = COLOR_METHODS[method]
+        except KeyError:
+            raise ValueError("unknown color method '{}'".format(method))
+
+    batch = getattr(method, "batch", False)
+    if not batch and method not in COLOR_METHODS.values():
+        single = method
+
+        def method(chunk):
+            return [single(tile) for tile in chunk]
+
+    colors = numpy.empty((len(tiles), 3), dtype=numpy.int64)
+
+    for start in range(0, len(tiles), chunk_size):
+        chunk = tiles[start:start + chunk_size]
+        colors[start:start + len(chunk)] = numpy.asarray(
+            method(chunk),
+            dtype=numpy.int64,
+        ).reshape((-1, 3))
+
+    return colors
+
+
+def srgb_to_lab(colors):
+    """Convert sRGB colors to CIELAB, under a D65 white point.
+
+    :param colors: An array of shape ``(..., 3)`` of RGB values from 0 to 255.
+        Integer values are converted using a lookup table.
+    :returns: An array of the same shape of L*, a* and b* values.
+
+    """
+
+    colors = numpy.asarray(colors)
+
+    if colors.dtype.kind in "iub":
+        linear = _LINEAR[numpy.clip(colors, 0, 255)]
+    else:
+        linear = _linearize(colors)
+
+    xyz = numpy.dot(linear, _RGB_TO_XYZ.T)
+
+    # the cube root, replaced by a straight line near black
+    f = numpy.where(
+        xyz > 216 / 24389.0,
+        numpy.cbrt(xyz),
+        (24389 / 27.0 * xyz + 16) / 116.0,
+    )
+
+    lab = numpy.empty(f.shape)
+    lab[..., 0] = 116 * f[..., 1] - 16
+    lab[..., 1] = 500 * (f[..., 0] - f[..., 1])
+    lab[..., 2] = 200 * (f[..., 1] - f[..., 2])
+
+    return lab
+
+
+def convert_colors(colors, color_space):
+    """Convert RGB colors, or descriptors made of several RGB colors, into the
+    color space they are matched in.
+
+    :param colors: An array whose last dimension is a multiple of 3, holding
+        RGB triples.
+    :param color_space: "rgb" or "lab".
+    :returns: A float array of the same shape.
+
+    """
+
+    colors = numpy.asarray(colors)
+
+    if color_space == "rgb":
+        return colors.astype(numpy.float64)
+
+    if color_space == "lab":
+        triples = colors.reshape(colors.shape[:-1] + (-1, 3))
+        return srgb_to_lab(triples).reshape(colors.shape)
+
+    raise ValueError("unknown color space '{}'".format(color_space))
+
+
+def delta_e76(lab1, lab2):
+    """Return the CIE76 color difference, the Euclidean distance in CIELAB.
+
+    :param lab1: An array of shape ``(..., 3)`` of CIELAB colors.
+    :param lab2: An array of CIELAB colors that broadcasts against `lab1`.
+    :returns: An array of differences.
+
+    """
+
+    diff = numpy.asarray(lab1, dtype=numpy.float64) - lab2
+
+    return numpy.sqrt(numpy.sum(diff * diff, axis=-1))
+
+
+def delta_e2000(lab1, lab2):
+    """Return the CIEDE2000 color difference.
+
+    This follows Sharma, Wu and Dalal, "The CIEDE2000 Color-Difference
+    Formula: Implementation Notes, Supplementary Test Data, and Mathematical
+    Observations" (2005).
+
+    :param lab1: An array of shape ``(..., 3)`` of CIELAB colors.
+    :param lab2: An array of CIELAB colors that broadcasts against `lab1`.
+    :returns: An array of differences.
+
+    """
+
+    lab1 = numpy.asarray(lab1, dtype=numpy.float64)
+    lab2 = numpy.asarray(lab2, dtype=numpy.float64)
+
+    l1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    l2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+    # stretch a* to correct for the hue of neutral colors
+    c_mean = (numpy.hypot(a1, b1) + numpy.hypot(a2, b2)) / 2
+    c_mean7 = c_mean ** 7
+    g = 0.5 * (1 - numpy.sqrt(c_mean7 / (c_mean7 + 25.0 ** 7)))
+
+    a1 = (1 + g) * a1
+    a2 = (1 + g) * a2
+
+    c1 = numpy.hypot(a1, b1)
+    c2 = numpy.hypot(a2, b2)
+
+    h1 = numpy.degrees(numpy.arctan2(b1, a1)) % 360
+    h2 = numpy.degrees(numpy.arctan2(b2, a2)) % 360
+
+    chromatic = (c1 * c2) != 0
+
+    # the hue difference, the short way around the circle
+    dh = h2 - h1
+    dh = numpy.where(dh > 180, dh - 360, dh)
+    dh = numpy.where(dh < -180, dh + 360, dh)
+    dh = numpy.where(chromatic, dh, 0)
+
+    dl = l2 - l1
+    dc = c2 - c1
+    dh = 2 * numpy.sqrt(c1 * c2) * numpy.sin(numpy.radians(dh) / 2)
+
+    l_mean = (l1 + l2) / 2
+    c_mean = (c1 + c2) / 2
+
+    # the mean hue, also the short way around
+    h_sum = h1 + h2
+    h_mean = numpy.where(
+        numpy.abs(h1 - h2) <= 180,
+        h_sum / 2,
+        numpy.where(h_sum < 360, (h_sum + 360) / 2, (h_sum - 360) / 2),
+    )
+    h_mean = numpy.where(chromatic, h_mean, h_sum)
+
+    t = (
+        1
+        - 0.17 * numpy.cos(numpy.radians(h_mean - 30))
+        + 0.24 * numpy.cos(numpy.radians(2 * h_mean))
+        + 0.32 * numpy.cos(numpy.radians(3 * h_mean + 6))
+        - 0.20 * numpy.cos(numpy.radians(4 * h_mean - 63))
+    )
+
+    rotation = 30 * numpy.exp(-((h_mean - 275) / 25) ** 2)
+    c_mean7 = c_mean ** 7
+    r_c = 2 * numpy.sqrt(c_mean7 / (c_mean7 + 25.0 ** 7))
+    r_t = -numpy.sin(numpy.radians(2 * rotation)) * r_c
+
+    l_offset = (l_mean - 50) ** 2
+    s_l = 1 + 0.015 * l_offset / numpy.sqrt(20 + l_offset)
+    s_c = 1 + 0.045 * c_mean
+    s_h = 1 + 0.015 * c_mean * t
+
+    dl = dl / s_l
+    dc = dc / s_c
+    dh = dh / s_h
+
+    return numpy.sqrt(dl * dl + dc * dc + dh * dh + r_t * dc * dh)
+
+
+def color_difference(points1, points2, difference="cie76"):
+    """Return the difference between CIELAB colors, or between descriptors
+    made of several CIELAB colors, as the sum of the differences of their
+    colors.
+
+    :param points1: An array whose last dimension is a multiple of 3, holding
+        CIELAB triples.
+    :param points2: An array that broadcasts against `points1`.
+    :param difference: "cie76" or "ciede2000" (default: "cie76").
+    :returns: An array of differences.
 
     """
 
-    counts = {}
-    for color in img.getdata(): # flat list of color tuples
-        if color not in counts:
-            counts[color] = 0
-        counts[color] += 1
+    try:
+        formula = {
+            "cie76": delta_e76,
+            "ciede2000": delta_e2000,
+        }[difference]
+    except KeyError:
+        raise ValueError("unknown color difference '{}'".format(difference))
 
-    # go from the mapping of color -> count to tuples of count, color
-    counted = [(count, color) for color, count in counts.items()]
+    points1 = numpy.asarray(points1, dtype=numpy.float64)
+    points2 = numpy.asarray(points2, dtype=numpy.float64)
 
-    # sort will sort on the first item, which is count
-    counted.sort()
+    points1 = points1.reshape(points1.shape[:-1] + (-1, 3))
+    points2 = points2.reshape(points2.shape[:-1] + (-1, 3))
 
-    # take the last item, which has the highest count
-    _, color = counted[-1]
-    return color
+    return formula(points1, points2).sum(axis=-1)
 
 
 def perceived_luminance(r, g, b):
@@ -74,6 +543,9 @@ def perceived_luminance(r, g, b):
 
     See http://alienryderflex.com/hsp.html for more information.
 
+    The values may also be arrays, in which case the luminance of each color is
+    returned as an array.
+
     :param r: Red value.
     :param g: Green value.
     :param b: Blue value.
@@ -81,5 +553,5 @@ def perceived_luminance(r, g, b):
 
     """
 
-    return math.sqrt(0.299 * r**2 + 0.587 * g**2 + 0.114 * b**2)
+    return numpy.sqrt(0.299 * r**2 + 0.587 * g**2 + 0.114 * b**2)
 
@@ -0,0 +1,136 @@
+# Copyright 2017, Ryan P. Kelly. All Rights Reserved.
+
+"""
+Rough estimates of how long a mosaic will take and how much memory its output
+needs, so a job can be sized before any work is done.
+
+The rates are single-core measurements of each step. They only aim to tell
+seconds from minutes from hours.
+"""
+
+from __future__ import absolute_import
+
+
+# seconds to decode and prepare one source image, for camera-sized JPEGs
+LOAD_SECONDS_PER_IMAGE = 2e-2
+
+# seconds to match one cell with the greedy method, and for the vectorized
+# index the extra seconds for every tile each cell is compared against
+KDTREE_SECONDS_PER_CELL = 3e-4
+VECTORIZED_SECONDS_PER_CELL = 2e-5
+VECTORIZED_SECONDS_PER_COMPARISON = 2e-9
+
+# seconds to place one cell with the assignment method
+ASSIGNMENT_SECONDS_PER_CELL = 1e-3
+
+# swaps the stochastic method evaluates per second, one at a time or batched
+SEQUENTIAL_GENERATIONS_PER_SECOND = 8e5
+BATCHED_GENERATIONS_PER_SECOND = 5e6
+
+# bytes of output rendered per second
+RENDER_BYTES_PER_SECOND = 1.5e8
+
+
+def estimate_job(columns, rows, tile_size, tile_count, pixel_method="random",
+                 match_method="kdtree", generations=1000000, batch_size=None,
+                 jobs=1, stream=False, load_count=0):
+    """Estimate the size of a mosaic job.
+
+    :param columns: How many tiles across the mosaic is.
+    :param rows: How many tiles down the mosaic is.
+    :param tile_size: How large each tile is in the output.
+    :param tile_count: How many source images there are.
+    :param pixel_method: The method choosing tiles, as for the command line
+        (default: "random").
+    :param match_method: The index the greedy methods match with, "kdtree" or
+        "vectorized" (default: "kdtree").
+    :param generations: How many swaps the stochastic method attempts
+        (default: 1,000,000).
+    :param batch_size: The stochastic method's batch size, if any (default:
+        None).
+    :param jobs: How many processes the stochastic method runs in (default:
+        1).
+    :param stream: Whether the output is written a row of tiles at a time
+        instead of being built in memory (default: False).
+    :param load_count: How many source images have to be loaded first, with
+        `jobs` processes (default: 0).
+    :returns: A dictionary of "cells", "width" and "height" (of the output, in
+        pixels), "memory" (bytes needed for the output image) and "seconds"
+        (to load the source images, choose the tiles and render them).
+
+    """
+
+    cells = columns * rows
+
+    width = columns * tile_size
+    height = rows * tile_size
+
+    if stream:
+        memory = width * tile_size * 3
+    else:
+        memory = width * height * 3
+
+    if pixel_method == "stochastic":
+        if batch_size is None:
+            rate = SEQUENTIAL_GENERATIONS_PER_SECOND
+        else:
+            rate = BATCHED_GENERATIONS_PER_SECOND
+        seconds = generations / (rate * max(1, jobs))
+    elif pixel_method == "assignment":
+        seconds = cells * ASSIGNMENT_SECONDS_PER_CELL
+    elif match_method == "vectorized":
+        seconds = cells * (
+            VECTORIZED_SECONDS_PER_CELL
+            + tile_count * VECTORIZED_SECONDS_PER_COMPARISON
+        )
+    else:
+        seconds = cells * KDTREE_SECONDS_PER_CELL
+
+    seconds += width * height * 3 / RENDER_BYTES_PER_SECOND
+    seconds += load_count * LOAD_SECONDS_PER_IMAGE / max(1, jobs)
+
+    return {
+        "cells": cells,
+        "width": width,
+        "height": height,
+        "memory": memory,
+        "seconds": seconds,
+    }
+
+
+def format_bytes(count):
+    """Format a number of bytes for people to read.
+
+    :param count: The number of bytes.
+    :returns: A string such as "1.5 GiB".
+
+    """
+
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if count < 1024:
+            return "{:.1f} {}".format(count, unit)
+        count /= 1024.0
+
+    return "{:.1f} TiB".format(count)
+
+
+def format_seconds(seconds):
+    """Format a duration for people to read.
+
+    :param seconds: The number of seconds.
+    :returns: A string such as "3m 20s".
+
+    """
+
+    seconds = int(round(seconds))
+
+    if seconds < 60:
+        return "{}s".format(seconds)
+
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return "{}m {}s".format(minutes, seconds)
+
+    hours, minutes = divmod(minutes, 60)
+
+    return "{}h {}m".format(hours, minutes)
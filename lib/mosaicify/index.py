@@ -0,0 +1,358 @@
+# Copyright 2017, Ryan P. Kelly. All Rights Reserved.
+
+"""
+Nearest-color indexes used to match reference pixels to source images.
+"""
+
+from __future__ import absolute_import
+
+import heapq
+
+import numpy
+
+
+class KDTreeIndex(object):
+    """A k-d tree over representative colors that answers "k nearest
+    available points" queries and supports removing points as they are used.
+
+    Points are addressed by their position in the array the index was built
+    from. Removed points can be restored all at once with `reset`, which is how
+    a depleted pool of source images is refilled.
+
+    """
+
+    def __init__(self, points, leaf_size=32):
+        """Build the tree.
+
+        :param points: A sequence of equal-length color vectors.
+        :param leaf_size: The largest number of points kept in a single leaf
+            (default: 32).
+
+        """
+
+        self._points = numpy.asarray(points, dtype=numpy.float64)
+        if self._points.ndim != 2:
+            self._points = self._points.reshape((len(self._points), -1))
+
+        self._leaf_size = max(1, leaf_size)
+
+        count = len(self._points)
+
+        # the points are grouped into leaves by permuting this array, each node
+        # covers a contiguous range of it
+        self._order = numpy.arange(count)
+        self._leaf_of = numpy.zeros(count, dtype=numpy.intp)
+
+        self._left = []
+        self._right = []
+        self._parent = []
+        self._start = []
+        self._stop = []
+        self._size = []
+        lows = []
+        highs = []
+
+        if count:
+            self._build(0, count, -1, lows, highs)
+
+        self._lows = numpy.array(lows)
+        self._highs = numpy.array(highs)
+
+        self.reset()
+
+    def _build(self, start, stop, parent, lows, highs):
+        """Recursively build the node covering ``_order[start:stop]``.
+
+        :param start: The start of the node's range.
+        :param stop: The end of the node's range.
+        :param parent: The parent node, or -1 for the root.
+        :param lows: The list of per-node lower bounds being built.
+        :param highs: The list of per-node upper bounds being built.
+        :returns: The id of the new node.
+
+        """
+
+        node = len(self._left)
+
+        members = self._points[self._order[start:stop]]
+        low = members.min(axis=0)
+        high = members.max(axis=0)
+
+        self._left.append(-1)
+        self._right.append(-1)
+        self._parent.append(parent)
+        self._start.append(start)
+        self._stop.append(stop)
+        self._size.append(stop - start)
+        lows.append(low)
+        highs.append(high)
+
+        spread = high - low
+        dim = int(numpy.argmax(spread))
+
+        # small enough, or every point is identical, so this is a leaf
+        if stop - start <= self._leaf_size or spread[dim] == 0:
+            self._leaf_of[self._order[start:stop]] = node
+            return node
+
+        # partition around the median of the widest dimension
+        mid = (start + stop) // 2
+        ids = self._order[start:stop]
+        split = numpy.argpartition(self._points[ids, dim], mid - start)
+        self._order[start:stop] = ids[split]
+
+        self._left[node] = self._build(start, mid, node, lows, highs)
+        self._right[node] = self._build(mid, stop, node, lows, highs)
+
+        return node
+
+    def __len__(self):
+        """Return the number of points still available."""
+
+        return self._alive[0] if self._alive else 0
+
+    def reset(self):
+        """Make every point available again."""
+
+        self._available = numpy.ones(len(self._points), dtype=bool)
+        self._alive = list(self._size)
+
+    def remove(self, point_id):
+        """Remove a point so it is no longer returned by `nearest`.
+
+        :param point_id: The position of the point in the original array.
+
+        """
+
+        if not self._available[point_id]:
+            raise ValueError("point {} already removed".format(point_id))
+
+        self._available[point_id] = False
+
+        node = self._leaf_of[point_id]
+        while node >= 0:
+            self._alive[node] -= 1
+            node = self._parent[node]
+
+    def _box_distance(self, node, point):
+        """Return the squared distance from a point to a node's bounding box.
+
+        :param node: The node id.
+        :param point: The query point.
+        :returns: The squared distance, 0 if the point is inside the box.
+
+        """
+
+        below = self._lows[node] - point
+        above = point - self._highs[node]
+        outside = numpy.maximum(numpy.maximum(below, above), 0)
+
+        return float(numpy.dot(outside, outside))
+
+    def nearest(self, point, k):
+        """Return the ids of the ``k`` nearest available points.
+
+        :param point: The query color.
+        :param k: How many points to return.
+        :returns: A list of point ids, closest first. Fewer than ``k`` ids are
+            returned if fewer points are available.
+
+        """
+
+        point = numpy.asarray(point, dtype=numpy.float64).ravel()
+
+        # best is a max-heap (by negated distance) of the closest points found
+        # so far, pending is a min-heap of nodes by distance to their box
+        best = []
+        pending = []
+        if len(self):
+            pending.append((0.0, 0))
+
+        while pending:
+            bound, node = heapq.heappop(pending)
+
+            # nothing left can beat the worst of the k we already have
+            if len(best) == k and bound >= -best[0][0]:
+                break
+
+            left = self._left[node]
+
+            if left < 0:
+                ids = self._order[self._start[node]:self._stop[node]]
+                ids = ids[self._available[ids]]
+
+                diff = self._points[ids] - point
+                distances = numpy.einsum("ij,ij->i", diff, diff)
+
+                for distance, point_id in zip(distances.tolist(), ids.tolist()):
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, point_id))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, point_id))
+
+                continue
+
+            for child in (left, self._right[node]):
+                if self._alive[child]:
+                    heapq.heappush(
+                        pending,
+                        (self._box_distance(child, point), child),
+                    )
+
+        best.sort(reverse=True)
+
+        return [point_id for _, point_id in best]
+
+    def nearest_each(self, points, k):
+        """Generate the ``k`` nearest available points for each of the given
+        query points in turn.
+
+        Each query is answered when it is reached, so points removed while
+        consuming the generator are respected by the following queries.
+
+        :param points: A sequence of query colors.
+        :param k: How many points to return for each query.
+        :returns: A generator of lists of point ids, closest first.
+
+        """
+
+        for point in points:
+            yield self.nearest(point, k)
+
+
+class VectorIndex(object):
+    """A brute-force index that keeps every color in one contiguous array and
+    finds the nearest available points with broadcasted NumPy operations.
+
+    This has the same interface as `KDTreeIndex`. It does more arithmetic per
+    query, but all of it happens inside NumPy, and the distances for a block of
+    query points are computed in a single operation.
+
+    """
+
+    def __init__(self, points, block_size=64):
+        """Build the index.
+
+        :param points: A sequence of equal-length color vectors.
+        :param block_size: How many query points `nearest_each` computes
+            distances for at once (default: 64).
+
+        """
+
+        self._points = numpy.ascontiguousarray(points, dtype=numpy.float64)
+        if self._points.ndim != 2:
+            self._points = self._points.reshape((len(self._points), -1))
+
+        # |p|^2 is reused by every distance computation
+        self._norms = numpy.einsum("ij,ij->i", self._points, self._points)
+
+        self._block_size = max(1, block_size)
+
+        self.reset()
+
+    def __len__(self):
+        """Return the number of points still available."""
+
+        return self._remaining
+
+    def reset(self):
+        """Make every point available again."""
+
+        self._available = numpy.ones(len(self._points), dtype=bool)
+        self._remaining = len(self._points)
+
+    def remove(self, point_id):
+        """Remove a point so it is no longer returned by `nearest`.
+
+        :param point_id: The position of the point in the original array.
+
+        """
+
+        if not self._available[point_id]:
+            raise ValueError("point {} already removed".format(point_id))
+
+        self._available[point_id] = False
+        self._remaining -= 1
+
+    def distances(self, points):
+        """Return the squared distances between query points and every point
+        in the index, available or not.
+
+        :param points: An array of query colors, one per row.
+        :returns: An array of shape ``(len(points), len(index points))``.
+
+        """
+
+        points = numpy.asarray(points, dtype=numpy.float64)
+        points = points.reshape((len(points), self._points.shape[1]))
+
+        # |a - b|^2 = |a|^2 - 2ab + |b|^2, as one matrix product
+        distances = numpy.dot(points, self._points.T)
+        distances *= -2
+        distances += self._norms
+        distances += numpy.einsum("ij,ij->i", points, points)[:, None]
+
+        # rounding can produce tiny negative values for exact matches
+        numpy.maximum(distances, 0, out=distances)
+
+        return distances
+
+    def _top(self, distances, k):
+        """Return the ``k`` nearest available points given the distances from
+        a query point to every point.
+
+        :param distances: A row as returned by `distances`. It is modified.
+        :param k: How many points to return.
+        :returns: A list of point ids, closest first.
+
+        """
+
+        distances[~self._available] = numpy.inf
+
+        k = min(k, self._remaining)
+        if k <= 0:
+            return []
+
+        if k < len(distances):
+            candidates = numpy.argpartition(distances, k - 1)[:k]
+        else:
+            candidates = numpy.arange(len(distances))
+
+        ordered = candidates[numpy.argsort(distances[candidates], kind="stable")]
+
+        return ordered.tolist()
+
+    def nearest(self, point, k):
+        """Return the ids of the ``k`` nearest available points.
+
+        :param point: The query color.
+        :param k: How many points to return.
+        :returns: A list of point ids, closest first. Fewer than ``k`` ids are
+            returned if fewer points are available.
+
+        """
+
+        return self._top(self.distances([point])[0], k)
+
+    def nearest_each(self, points, k):
+        """Generate the ``k`` nearest available points for each of the given
+        query points in turn.
+
+        Distances are computed a block of query points at a time, but the
+        availability of each point is checked when its query is reached, so
+        points removed while consuming the generator are respected by the
+        following queries.
+
+        :param points: A sequence of query colors.
+        :param k: How many points to return for each query.
+        :returns: A generator of lists of point ids, closest first.
+
+        """
+
+        points = numpy.asarray(points, dtype=numpy.float64)
+
+        for start in range(0, len(points), self._block_size):
+            block = self.distances(points[start:start + self._block_size])
+
+            for row in block:
+                yield self._top(row, k)
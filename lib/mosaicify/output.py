@@ -2,10 +2,66 @@
 
 from __future__ import absolute_import
 
+import os
+import struct
+
+import numpy
 from PIL import Image
 
 
-def output_from_matrix(reference_image, tile_size, output_matrix):
+# classic TIFF offsets are 32-bit, so anything larger is written as BigTIFF.
+# leave some room for the header and directory.
+_CLASSIC_TIFF_LIMIT = 2**32 - 2**20
+
+# TIFF field types: (type code, struct format character)
+_SHORT = (3, "H")
+_LONG = (4, "I")
+_LONG8 = (16, "Q")
+
+
+def _paste_tile(canvas, image, paste_box):
+    """Paste one tile of the output matrix onto a canvas.
+
+    :param canvas: The image being pasted onto.
+    :param image: A source image, either an image object or an array of RGB
+        pixels.
+    :param paste_box: The (left, upper, right, lower) box to paste into.
+
+    """
+
+    if isinstance(image, numpy.ndarray):
+        image = Image.fromarray(image, "RGB")
+
+    canvas.paste(image, paste_box)
+
+
+def matrix_rows(output_matrix, registry=None):
+    """Generate the rows of an output matrix as lists of source images.
+
+    :param output_matrix: An array of shape ``(height, width)`` of tile ids,
+        or a list of rows of source images.
+    :param registry: The `TileRegistry` the tile ids refer to. Required for an
+        array of tile ids.
+    :returns: A generator of lists of source images, either image objects or
+        arrays of RGB pixels.
+
+    """
+
+    if registry is None:
+        if isinstance(output_matrix, numpy.ndarray):
+            raise ValueError("a matrix of tile ids needs a registry")
+
+        for row in output_matrix:
+            yield row
+
+        return
+
+    for row in numpy.asarray(output_matrix).tolist():
+        yield [registry.tile(tile_id) for tile_id in row]
+
+
+def output_from_matrix(reference_image, tile_size, output_matrix,
+                       registry=None):
     """Generate the output mosaic image by laying out the output matrix into a
     single image canvas.
 
@@ -13,7 +69,12 @@ def output_from_matrix(reference_image, tile_size, output_matrix):
         output.
     :param tile_size: How large each source image will be rendered in the final
         output.
-    :param output_matrix: An list of python lists consisting of source images.
+    :param output_matrix: An array of shape ``(height, width)`` of tile ids,
+        as returned by the ``create_matrix`` functions. A list of python lists
+        consisting of source images, either image objects or arrays of RGB
+        pixels such as the tiles of a `TileAtlas`, is also accepted.
+    :param registry: The `TileRegistry` the tile ids refer to. Required for an
+        array of tile ids.
     :returns: An image object.
 
     """
@@ -24,7 +85,7 @@ def output_from_matrix(reference_image, tile_size, output_matrix):
     output_image = Image.new("RGB", (output_width, output_height))
 
     y_offset = 0
-    for row in output_matrix:
+    for row in matrix_rows(output_matrix, registry):
 
         x_offset = 0
 
@@ -37,10 +98,226 @@ def output_from_matrix(reference_image, tile_size, output_matrix):
                 y_offset + tile_size,
             )
 
-            output_image.paste(image, paste_box)
+            _paste_tile(output_image, image, paste_box)
 
             x_offset += tile_size
 
         y_offset += tile_size
 
     return output_image
+
+
+def _strips(reference_image, tile_size, output_matrix, registry):
+    """Generate the output mosaic one row of tiles at a time.
+
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :param tile_size: How large each source image will be rendered in the final
+        output.
+    :param output_matrix: The output matrix, as for `output_from_matrix`.
+    :param registry: The `TileRegistry` the tile ids refer to, if any.
+    :returns: A generator of raw RGB bytes, one strip of ``tile_size`` rows of
+        the output image at a time.
+
+    """
+
+    output_width = tile_size * reference_image.width
+
+    for row in matrix_rows(output_matrix, registry):
+
+        strip = Image.new("RGB", (output_width, tile_size))
+
+        x_offset = 0
+        for image in row:
+
+            paste_box = (
+                x_offset,
+                0,
+                x_offset + tile_size,
+                tile_size,
+            )
+
+            _paste_tile(strip, image, paste_box)
+
+            x_offset += tile_size
+
+        yield strip.tobytes()
+
+
+def write_ppm(reference_image, tile_size, output_matrix, path, registry=None):
+    """Write the output mosaic straight to a binary PPM file, holding only one
+    row of tiles in memory at a time.
+
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :param tile_size: How large each source image will be rendered in the final
+        output.
+    :param output_matrix: The output matrix, as for `output_from_matrix`.
+    :param path: The path to write to.
+    :param registry: The `TileRegistry` the tile ids refer to. Required for an
+        array of tile ids.
+
+    """
+
+    output_width = tile_size * reference_image.width
+    output_height = tile_size * reference_image.height
+
+    with open(path, "wb") as fp:
+
+        header = "P6\n{} {}\n255\n".format(output_width, output_height)
+        fp.write(header.encode("ascii"))
+
+        strips = _strips(reference_image, tile_size, output_matrix, registry)
+        for strip in strips:
+            fp.write(strip)
+
+
+def _tiff_directory(entries, offset, big):
+    """Serialize a TIFF image file directory.
+
+    :param entries: A list of (tag, field type, values) tuples.
+    :param offset: The file offset the directory will be written at.
+    :param big: Whether to use the BigTIFF layout.
+    :returns: The bytes of the directory followed by any values too large to
+        fit in their entries.
+
+    """
+
+    if big:
+        count_format, entry_format, next_format, inline = "<Q", "<HHQ", "<Q", 8
+    else:
+        count_format, entry_format, next_format, inline = "<H", "<HHI", "<I", 4
+
+    entry_size = struct.calcsize(entry_format) + inline
+    directory_size = (
+        struct.calcsize(count_format)
+        + entry_size * len(entries)
+        + struct.calcsize(next_format)
+    )
+
+    directory = [struct.pack(count_format, len(entries))]
+    extra = []
+    extra_offset = offset + directory_size
+
+    for tag, (field_type, field_format), values in sorted(entries):
+
+        data = struct.pack("<{}{}".format(len(values), field_format), *values)
+
+        if len(data) <= inline:
+            value = data.ljust(inline, b"\0")
+        else:
+            value = struct.pack(next_format, extra_offset + len(b"".join(extra)))
+            extra.append(data)
+
+        directory.append(struct.pack(entry_format, tag, field_type, len(values)))
+        directory.append(value)
+
+    # there are no further directories
+    directory.append(struct.pack(next_format, 0))
+
+    return b"".join(directory + extra)
+
+
+def write_tiff(reference_image, tile_size, output_matrix, path, registry=None):
+    """Write the output mosaic straight to an uncompressed TIFF file, holding
+    only one row of tiles in memory at a time.
+
+    Each row of tiles becomes one strip of the TIFF. Outputs too large for a
+    classic TIFF are written as BigTIFF.
+
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :param tile_size: How large each source image will be rendered in the final
+        output.
+    :param output_matrix: The output matrix, as for `output_from_matrix`.
+    :param path: The path to write to.
+    :param registry: The `TileRegistry` the tile ids refer to. Required for an
+        array of tile ids.
+
+    """
+
+    output_width = tile_size * reference_image.width
+    output_height = tile_size * reference_image.height
+
+    strip_size = output_width * tile_size * 3
+    strip_count = reference_image.height
+
+    big = strip_size * strip_count > _CLASSIC_TIFF_LIMIT
+
+    if big:
+        header_size = 16
+        offset_type = _LONG8
+    else:
+        header_size = 8
+        offset_type = _LONG
+
+    # strips are written straight after the header, so every offset is known
+    # before any pixel data is produced
+    strip_offsets = [header_size + i * strip_size for i in range(strip_count)]
+    directory_offset = header_size + strip_size * strip_count
+
+    # the directory has to start on a word boundary
+    padding = directory_offset % 2
+    directory_offset += padding
+
+    entries = [
+        (256, _LONG, [output_width]),
+        (257, _LONG, [output_height]),
+        (258, _SHORT, [8, 8, 8]),  # bits per sample
+        (259, _SHORT, [1]),  # no compression
+        (262, _SHORT, [2]),  # RGB
+        (273, offset_type, strip_offsets),
+        (277, _SHORT, [3]),  # samples per pixel
+        (278, _LONG, [tile_size]),  # rows per strip
+        (279, offset_type, [strip_size] * strip_count),
+        (284, _SHORT, [1]),  # interleaved samples
+    ]
+
+    with open(path, "wb") as fp:
+
+        if big:
+            fp.write(struct.pack("<2sHHHQ", b"II", 43, 8, 0, directory_offset))
+        else:
+            fp.write(struct.pack("<2sHI", b"II", 42, directory_offset))
+
+        strips = _strips(reference_image, tile_size, output_matrix, registry)
+        for strip in strips:
+            fp.write(strip)
+
+        fp.write(b"\0" * padding)
+        fp.write(_tiff_directory(entries, directory_offset, big))
+
+
+STREAM_WRITERS = {
+    ".ppm": write_ppm,
+    ".pnm": write_ppm,
+    ".tif": write_tiff,
+    ".tiff": write_tiff,
+}
+
+
+def stream_output_from_matrix(reference_image, tile_size, output_matrix, path,
+                              registry=None):
+    """Write the output mosaic straight to disk with bounded memory, choosing
+    the format from the extension of `path`.
+
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :param tile_size: How large each source image will be rendered in the final
+        output.
+    :param output_matrix: The output matrix, as for `output_from_matrix`.
+    :param path: The path to write to. Its extension must be one of those in
+        `STREAM_WRITERS`.
+    :param registry: The `TileRegistry` the tile ids refer to. Required for an
+        array of tile ids.
+
+    """
+
+    _, extension = os.path.splitext(path)
+
+    try:
+        writer = STREAM_WRITERS[extension.lower()]
+    except KeyError:
+        raise ValueError("can't stream output to '{}' files".format(extension))
+
+    writer(reference_image, tile_size, output_matrix, path, registry=registry)
@@ -2,14 +2,287 @@
 
 """
 Pixel-related functions.
+
+The orderings are computed as arrays of flat pixel indices, where the pixel at
+(x, y) has index ``y * width + x``. Each ``*_indices`` function has a
+``*_pixels`` counterpart that returns the same ordering as a list of (x, y)
+tuples.
 """
 
 from __future__ import absolute_import
 
+import math
 import random
 
-from mosaicify.colors import perceived_luminance
+import numpy
+from PIL import Image
+
+from mosaicify.colors import (
+    convert_colors,
+    perceived_luminance,
+)
+
+
+# the value shown as white in the high bit depth modes: 16-bit images always
+# use their full range, 32-bit integer images are usually 16-bit images
+# loaded into a wider mode, and floating point images are usually 0 to 1
+WHITE_POINTS = {
+    "I;16": 65535,
+    "I;16B": 65535,
+    "I;16L": 65535,
+    "I;16N": 65535,
+    "I": 65535,
+    "F": 1.0,
+}
+
+
+def reference_array(reference_image, white=None):
+    """Return the pixels of the reference image as an array of 8-bit RGB
+    values, whatever the image's mode.
+
+    Palette images are expanded through their palette, transparent pixels are
+    composited onto white and high bit depth images are scaled down to 8 bits.
+
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :param white: The value shown as white in an "I" or "F" image. Use `None`
+        for the mode's entry in `WHITE_POINTS` (default: None). 16-bit images
+        are always scaled from their full range.
+    :returns: An array of shape ``(height, width, 3)`` of RGB values.
+
+    """
+
+    image = reference_image
+
+    if image.mode == "RGB":
+        return numpy.asarray(image)
+
+    if image.mode == "P":
+        # the palette may have a transparent entry
+        if "transparency" in image.info:
+            image = image.convert("RGBA")
+        else:
+            image = image.convert("RGB")
+
+    if image.mode in WHITE_POINTS:
+        values = numpy.asarray(image, dtype=numpy.float64)
+
+        if white is None or image.mode.startswith("I;16"):
+            white = WHITE_POINTS[image.mode]
+
+        values = values * (255.0 / white)
+
+        gray = numpy.clip(numpy.round(values), 0, 255).astype(numpy.uint8)
+
+        return numpy.repeat(gray[:, :, None], 3, axis=2)
+
+    if image.mode in ("LA", "La", "PA", "RGBa", "RGBA"):
+        rgba = numpy.asarray(image.convert("RGBA"), dtype=numpy.float64)
+
+        alpha = rgba[:, :, 3:] / 255.0
+        rgb = rgba[:, :, :3] * alpha + 255 * (1 - alpha)
+
+        return numpy.round(rgb).astype(numpy.uint8)
+
+    # L, 1, CMYK, YCbCr, LAB and HSV all have conversions of their own
+    return numpy.asarray(image.convert("RGB"))
+
+
+def grid_size(size, columns=None, rows=None, tiles=None):
+    """Work out the mosaic grid for a reference image of the given size.
+
+    Whatever is not given is chosen to keep the image's aspect ratio.
+
+    :param size: The (width, height) of the reference image.
+    :param columns: How many tiles across the mosaic should be.
+    :param rows: How many tiles down the mosaic should be.
+    :param tiles: Roughly how many tiles the mosaic should have in total.
+        Can't be combined with `columns` or `rows`.
+    :returns: A (columns, rows) tuple. If nothing is given, this is `size`.
+
+    """
+
+    width, height = size
 
+    if tiles is not None:
+        if columns is not None or rows is not None:
+            raise ValueError("give either a number of tiles or columns/rows")
+
+        scale = math.sqrt(tiles / float(width * height))
+        columns = width * scale
+        rows = height * scale
+    elif columns is not None and rows is None:
+        rows = columns * height / float(width)
+    elif rows is not None and columns is None:
+        columns = rows * width / float(height)
+    elif columns is None and rows is None:
+        return (width, height)
+
+    return (max(1, int(round(columns))), max(1, int(round(rows))))
+
+
+def resize_reference(reference_image, columns=None, rows=None, tiles=None,
+                     white=None):
+    """Resize the reference image to the mosaic grid, where every pixel
+    becomes one tile.
+
+    Pixels are area-averaged, so each one is the average of the part of the
+    original it covers.
+
+    :param reference_image: The full size reference image.
+    :param columns: How many tiles across the mosaic should be.
+    :param rows: How many tiles down the mosaic should be.
+    :param tiles: Roughly how many tiles the mosaic should have in total.
+    :param white: The value shown as white in a high bit depth image, see
+        `reference_array` (default: None).
+    :returns: An RGB image object with one pixel per tile. See `grid_size`
+        for how its size is chosen.
+
+    """
+
+    size = grid_size(
+        reference_image.size,
+        columns=columns,
+        rows=rows,
+        tiles=tiles,
+    )
+
+    image = Image.fromarray(
+        reference_array(reference_image, white=white),
+        "RGB",
+    )
+
+    if image.size == size:
+        return image
+
+    return image.resize(size, Image.BOX)
+
+
+def reference_descriptors(reference_image, cells, original_image=None):
+    """Return a descriptor of every pixel of the reference image, to match
+    against `TileRegistry.descriptors`.
+
+    Every pixel becomes an N by N block, and each pixel's descriptor is the
+    colors of its block. The blocks are area-averaged from the full size
+    original when it is given and large enough, so they hold the detail of
+    the edges that pass through them. Otherwise the reference is upscaled,
+    which only interpolates between neighboring pixels.
+
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :param cells: How many cells across each descriptor is.
+    :param original_image: The full size image the reference was resized
+        from, or `None` (default: None).
+    :returns: An array of shape ``(width * height, cells * cells * 3)``, in
+        flat pixel index order.
+
+    """
+
+    width = reference_image.width
+    height = reference_image.height
+    size = (width * cells, height * cells)
+
+    if original_image is None:
+        original_image = reference_image
+
+    image = Image.fromarray(reference_array(original_image), "RGB")
+
+    if image.size == size:
+        scaled = image
+    elif image.width >= size[0] and image.height >= size[1]:
+        scaled = image.resize(size, Image.BOX)
+    else:
+        scaled = image.resize(size, Image.BICUBIC)
+
+    blocks = numpy.asarray(scaled).reshape((height, cells, width, cells, 3))
+
+    return blocks.transpose((0, 2, 1, 3, 4)).reshape((width * height, -1))
+
+
+def match_points(reference_image, registry, cells=1, color_space="rgb",
+                 original_image=None):
+    """Return the points that tiles and reference pixels are matched by.
+
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :param registry: The `TileRegistry` of tiles.
+    :param cells: If more than 1, use descriptors of N by N cells rather than
+        representative colors (default: 1).
+    :param color_space: The color space to match in, "rgb" or "lab" (default:
+        "rgb").
+    :param original_image: The full size image the reference was resized
+        from, which descriptors are taken from, see `reference_descriptors`
+        (default: None).
+    :returns: A tuple of the float arrays of tile points, one row per tile,
+        and of reference points, one row per pixel in flat pixel index order.
+
+    """
+
+    if cells > 1:
+        tile_points = registry.descriptors(cells)
+        reference_points = reference_descriptors(
+            reference_image,
+            cells,
+            original_image=original_image,
+        )
+    else:
+        tile_points = registry.colors
+        reference_points = reference_array(reference_image).reshape((-1, 3))
+
+    return (
+        convert_colors(tile_points, color_space),
+        convert_colors(reference_points, color_space),
+    )
+
+
+def pixel_coordinates(indices, width):
+    """Convert flat pixel indices into (x, y) tuples.
+
+    :param indices: An array of flat pixel indices.
+    :param width: The width of the image the indices refer to.
+    :returns: A list of pixel coordinate tuples.
+
+    """
+
+    ys, xs = numpy.divmod(numpy.asarray(indices), width)
+
+    return list(zip(xs.tolist(), ys.tolist()))
+
+
+def pixel_indices(pixels, width):
+    """Convert pixel coordinates into flat pixel indices.
+
+    :param pixels: Either a list of (x, y) tuples, or an array of flat pixel
+        indices which is returned as is.
+    :param width: The width of the image the coordinates refer to.
+    :returns: An array of flat pixel indices.
+
+    """
+
+    if isinstance(pixels, numpy.ndarray):
+        return pixels
+
+    coordinates = numpy.array(pixels, dtype=numpy.intp).reshape((-1, 2))
+
+    return coordinates[:, 1] * width + coordinates[:, 0]
+
+
+def ordered_indices(reference_image):
+    """Returns an array of flat pixel indices, ordered by column.
+
+    See `ordered_pixels`.
+
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :returns: An array of flat pixel indices.
+
+    """
+
+    width = reference_image.width
+    height = reference_image.height
+
+    # transposing a row-major grid of indices walks it column by column
+    return numpy.arange(width * height).reshape((height, width)).T.ravel()
 
 
 def ordered_pixels(reference_image):
@@ -25,12 +298,25 @@ def ordered_pixels(reference_image):
 
     """
 
-    pixels = []
-    for x in range(reference_image.width):
-        for y in range(reference_image.height):
-            pixels.append((x, y))
+    return pixel_coordinates(
+        ordered_indices(reference_image),
+        reference_image.width,
+    )
 
-    return pixels
+
+def random_indices(reference_image):
+    """Returns a randomized array of flat pixel indices.
+
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :returns: An array of flat pixel indices.
+
+    """
+
+    # seeded from `random`, so that seeding it repeats the order
+    rng = numpy.random.default_rng(random.getrandbits(64))
+
+    return rng.permutation(reference_image.width * reference_image.height)
 
 
 def random_pixels(reference_image):
@@ -43,34 +329,61 @@ def random_pixels(reference_image):
 
     """
 
-    pixels = ordered_pixels(reference_image)
+    return pixel_coordinates(
+        random_indices(reference_image),
+        reference_image.width,
+    )
 
-    random.shuffle(pixels)
 
-    return pixels
+def _column_order(values):
+    """Return an image-shaped array of per-pixel values in the order given by
+    `ordered_indices`.
 
+    :param values: An array of shape ``(height, width)``.
+    :returns: A flat array.
 
-def _pixels_with_brightness(reference_image):
-    """Returns a list of (brightness, (x, y coordinate)) tuples.
+    """
+
+    return values.T.ravel()
+
+
+def _brightness(reference_image):
+    """Returns the perceived luminance of every pixel, in the order given by
+    `ordered_indices`.
 
     :param reference_image: The image that is the source of pixels for the
         output.
-    :returns: A list of brightness and pixel coordinate tuples.
+    :returns: A tuple of the array of flat pixel indices in column order and
+        the array of their luminance.
 
     """
 
-    pixels = ordered_pixels(reference_image)
+    rgb = reference_array(reference_image).astype(numpy.float64)
+
+    brightness = perceived_luminance(rgb[..., 0], rgb[..., 1], rgb[..., 2])
+
+    return (
+        ordered_indices(reference_image),
+        _column_order(brightness),
+    )
+
+
+def midtone_indices(reference_image):
+    """Returns an array of flat pixel indices, ordered by how far they are from
+    the average luminance.
 
-    with_brightness = []
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :returns: An array of flat pixel indices.
 
-    for x, y in pixels:
-        r, g, b = reference_image.getpixel((x, y))
+    """
 
-        brightness = perceived_luminance(r, g, b)
+    indices, brightness = _brightness(reference_image)
 
-        with_brightness.append((brightness, (x, y)))
+    distance = numpy.abs(brightness.mean() - brightness)
 
-    return with_brightness
+    # a stable sort keeps equally distant pixels in column order
+    return indices[numpy.argsort(distance, kind="stable")]
 
 
 def midtone_pixels(reference_image):
@@ -83,27 +396,38 @@ def midtone_pixels(reference_image):
 
     """
 
-    with_brightness = _pixels_with_brightness(reference_image)
+    return pixel_coordinates(
+        midtone_indices(reference_image),
+        reference_image.width,
+    )
+
 
-    total_brightness = sum([b for b, _ in with_brightness])
-    average_brightness = total_brightness / len(with_brightness)
+def darkest_indices(reference_image):
+    """Returns an array of flat pixel indices, ordered by how far they are from
+    0 luminance.
 
-    def midtone_sort(v):
-        """Return the distance between the brightness value of the given tuple
-        and the average brightness.
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :returns: An array of flat pixel indices.
 
-        :param v: A (brightness, pixel location) tuple.
-        :returns: A positive number representing the difference between the
-            brightness given by `v` and the average brightness.
+    """
 
-        """
+    rgb = reference_array(reference_image).astype(numpy.int64)
 
-        b, _ = v
-        return abs(average_brightness - b)
+    # luminance is the square root of this weighted sum, so ordering by the sum
+    # (scaled to stay integral) gives the same order
+    key = 299 * rgb[..., 0]**2 + 587 * rgb[..., 1]**2 + 114 * rgb[..., 2]**2
+    key = _column_order(key)
 
-    with_brightness.sort(key=midtone_sort)
+    # fold each pixel's position into its key so that a plain sort, which is
+    # much faster than a stable argsort, keeps equally bright pixels in column
+    # order
+    count = len(key)
+    key *= count
+    key += numpy.arange(count)
+    key.sort()
 
-    return [(x, y) for _, (x, y) in with_brightness]
+    return ordered_indices(reference_image)[key % count]
 
 
 def darkest_pixels(reference_image):
@@ -116,11 +440,23 @@ def darkest_pixels(reference_image):
 
     """
 
-    with_brightness = _pixels_with_brightness(reference_image)
+    return pixel_coordinates(
+        darkest_indices(reference_image),
+        reference_image.width,
+    )
 
-    with_brightness.sort()
 
-    return [(x, y) for _, (x, y) in with_brightness]
+def brightest_indices(reference_image):
+    """Returns an array of flat pixel indices, ordered by how far they are from
+    the maximum luminance.
+
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :returns: An array of flat pixel indices.
+
+    """
+
+    return darkest_indices(reference_image)[::-1]
 
 
 def brightest_pixels(reference_image):
@@ -133,8 +469,7 @@ def brightest_pixels(reference_image):
 
     """
 
-    pixels = darkest_pixels(reference_image)
-    pixels.reverse()
-
-    return pixels
-
+    return pixel_coordinates(
+        brightest_indices(reference_image),
+        reference_image.width,
+    )
@@ -0,0 +1,181 @@
+# Copyright 2017, Ryan P. Kelly. All Rights Reserved.
+
+"""
+Placement plans, which record the tiles chosen for a mosaic so that it can be
+rendered again, at another tile size or to another format, without loading
+and matching the whole library a second time.
+
+A plan is a compressed NumPy ``.npz`` file holding the grid of tile ids, the
+number of tiles in the library, fingerprints of the library's paths and, when
+the files were at hand, of their sizes and modification times, and the
+parameters the plan was made with.
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+
+import numpy
+
+
+PLAN_VERSION = 1
+
+
+def library_fingerprint(paths, tile_count, files=False):
+    """Return a fingerprint identifying a library of source images.
+
+    The paths, relative to the directory they share, and their order go into
+    the fingerprint. Representative colors change with the tile size, so
+    leaving them out lets a plan be rendered at any size.
+
+    :param paths: The paths of the source images in tile id order, or `None`
+        if they are not known.
+    :param tile_count: The number of tiles in the library.
+    :param files: Whether to also include the size and modification time of
+        every file, so that a library whose images were replaced under the
+        same names is told apart (default: False).
+    :returns: A hex digest, or `None` if `files` is set and some of the files
+        can't be found.
+
+    """
+
+    digest = hashlib.sha1(str(tile_count).encode("utf-8"))
+
+    if paths:
+        # the common prefix is cut back to the last whole directory
+        root = os.path.dirname(os.path.commonprefix(list(paths)))
+
+        for path in paths:
+            relative = os.path.relpath(path, root).replace(os.sep, "/")
+            digest.update(b"\0")
+            digest.update(relative.encode("utf-8"))
+
+            if files:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    return None
+
+                mtime = getattr(stat, "st_mtime_ns", stat.st_mtime)
+                digest.update(repr((stat.st_size, mtime)).encode("utf-8"))
+    elif files:
+        return None
+
+    return digest.hexdigest()
+
+
+def save_plan(path, output_matrix, registry, parameters=None):
+    """Write a placement plan.
+
+    :param path: The path to write to.
+    :param output_matrix: An array of shape ``(height, width)`` of tile ids, as
+        returned by the ``create_matrix`` functions.
+    :param registry: The `TileRegistry` the tile ids refer to.
+    :param parameters: An optional dictionary of the parameters the plan was
+        made with. It must be serializable as JSON.
+
+    """
+
+    output_matrix = numpy.asarray(output_matrix, dtype=numpy.int32)
+    if output_matrix.ndim != 2:
+        raise ValueError("a plan needs a two dimensional matrix of tile ids")
+
+    tile_count = len(registry)
+
+    # written to an open file, so numpy doesn't add an extension to the path
+    with open(path, "wb") as fp:
+        numpy.savez_compressed(
+            fp,
+            version=numpy.array(PLAN_VERSION),
+            matrix=output_matrix,
+            tile_count=numpy.array(tile_count),
+            fingerprint=numpy.array(
+                library_fingerprint(registry.paths, tile_count),
+            ),
+            # empty when the source files aren't at hand, as with an atlas
+            # that was moved away from them
+            file_fingerprint=numpy.array(
+                library_fingerprint(registry.paths, tile_count, files=True)
+                or "",
+            ),
+            parameters=numpy.array(json.dumps(parameters or {})),
+        )
+
+
+def load_plan(path):
+    """Read a placement plan written by `save_plan`.
+
+    :param path: The path to the plan.
+    :returns: A dictionary of "matrix" (the array of tile ids), "tile_count",
+        "fingerprint", "file_fingerprint" (`None` if the plan was made without
+        the source files at hand) and "parameters".
+
+    """
+
+    with numpy.load(path, allow_pickle=False) as plan:
+        version = int(plan["version"])
+        if version != PLAN_VERSION:
+            raise ValueError("unsupported plan version {}".format(version))
+
+        # plans written before sizes and modification times were recorded
+        # don't have them
+        file_fingerprint = None
+        if "file_fingerprint" in plan.files:
+            file_fingerprint = str(plan["file_fingerprint"]) or None
+
+        return {
+            "matrix": plan["matrix"],
+            "tile_count": int(plan["tile_count"]),
+            "fingerprint": str(plan["fingerprint"]),
+            "file_fingerprint": file_fingerprint,
+            "parameters": json.loads(str(plan["parameters"])),
+        }
+
+
+def check_plan(plan, paths):
+    """Check that a plan was made from a library of source images.
+
+    :param plan: A plan, as returned by `load_plan`.
+    :param paths: The paths of the library's source images, in tile id order.
+        When both the plan and this check have the files at hand, their sizes
+        and modification times have to match too.
+    :raises ValueError: If the library is not the one the plan was made from.
+
+    """
+
+    if len(paths) != plan["tile_count"]:
+        raise ValueError(
+            "plan was made from {} source images, but there are {}".format(
+                plan["tile_count"],
+                len(paths),
+            )
+        )
+
+    if library_fingerprint(paths, len(paths)) != plan["fingerprint"]:
+        raise ValueError("plan was made from a different library")
+
+    if plan.get("file_fingerprint") is None:
+        return
+
+    file_fingerprint = library_fingerprint(paths, len(paths), files=True)
+
+    if file_fingerprint not in (None, plan["file_fingerprint"]):
+        raise ValueError("source images have changed since the plan was made")
+
+
+def used_tiles(output_matrix):
+    """Find the tiles a matrix uses, so only those need to be loaded.
+
+    :param output_matrix: An array of shape ``(height, width)`` of tile ids.
+    :returns: A tuple of a sorted array of the tile ids used and a matrix of
+        the same shape numbering those tiles from 0, in the same order.
+
+    """
+
+    tile_ids, inverse = numpy.unique(output_matrix, return_inverse=True)
+
+    compact_matrix = inverse.reshape(output_matrix.shape).astype(numpy.int32)
+
+    return tile_ids, compact_matrix
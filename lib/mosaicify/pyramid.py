@@ -0,0 +1,305 @@
+# Copyright 2017, Ryan P. Kelly. All Rights Reserved.
+
+"""
+Deep Zoom (DZI) tile pyramid output.
+
+Every level of the pyramid is rendered straight from the output matrix, using
+copies of the source images downscaled to that level, so the full resolution
+mosaic never has to be assembled or read back.
+"""
+
+from __future__ import absolute_import
+
+import math
+import os
+
+import numpy
+from PIL import Image
+
+
+DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"
+  Format="{format}"
+  Overlap="{overlap}"
+  TileSize="{tile_size}"
+  >
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+
+
+def _as_image(image):
+    """Return a source image from the output matrix as an image object.
+
+    :param image: An image object or an array of RGB pixels.
+    :returns: An image object.
+
+    """
+
+    if isinstance(image, numpy.ndarray):
+        return Image.fromarray(image, "RGB")
+
+    return image
+
+
+def _image_key(image):
+    """Return a key identifying the source image an output matrix entry
+    refers to, so that each one is only downscaled once per level.
+
+    :param image: An image object or an array of RGB pixels.
+    :returns: A hashable key.
+
+    """
+
+    # atlas tiles are separate views onto the same memory
+    if isinstance(image, numpy.ndarray):
+        return image.__array_interface__["data"][0]
+
+    return id(image)
+
+
+def _cell_keys(output_matrix, registry):
+    """Return a key for the source image of every cell of the mosaic, and a
+    way to look up the image for a key.
+
+    :param output_matrix: The output matrix, as for `output_from_matrix`.
+    :param registry: The `TileRegistry` the tile ids refer to, if any.
+    :returns: A tuple of an array of shape ``(height, width)`` of keys and a
+        function returning the source image for a key.
+
+    """
+
+    if registry is not None:
+        return (numpy.asarray(output_matrix), registry.tile)
+
+    if isinstance(output_matrix, numpy.ndarray):
+        raise ValueError("a matrix of tile ids needs a registry")
+
+    images = {}
+    keys = []
+    for row in output_matrix:
+
+        key_row = []
+        for image in row:
+            key = _image_key(image)
+            images[key] = image
+            key_row.append(key)
+
+        keys.append(key_row)
+
+    return (numpy.array(keys, dtype=numpy.int64), images.__getitem__)
+
+
+def _edges(count, tile_size, scale):
+    """Return where each cell of the mosaic starts at a pyramid level.
+
+    :param count: The number of cells along the axis.
+    :param tile_size: How large each source image is at full resolution.
+    :param scale: How many full resolution pixels make up one pixel of the
+        level.
+    :returns: An array of ``count + 1`` pixel offsets. Cells narrower than a
+        pixel share an offset with their neighbor.
+
+    """
+
+    # ceiling division keeps the last edge equal to the level's size
+    return -(-numpy.arange(count + 1) * tile_size // scale)
+
+
+def _render_region(keys, lookup, x_edges, y_edges, box, thumbnails):
+    """Render part of a pyramid level by pasting downscaled source images.
+
+    :param keys: The keys of the cells' source images, as returned by
+        `_cell_keys`.
+    :param lookup: The function returning the source image for a key.
+    :param x_edges: The cell offsets along x, as returned by `_edges`.
+    :param y_edges: The cell offsets along y, as returned by `_edges`.
+    :param box: The (left, upper, right, lower) region of the level to render.
+    :param thumbnails: A dictionary of source images already downscaled for
+        this level, which is added to.
+    :returns: An image object.
+
+    """
+
+    left, upper, right, lower = box
+
+    region = Image.new("RGB", (right - left, lower - upper))
+
+    first_x = numpy.searchsorted(x_edges, left, "right") - 1
+    last_x = numpy.searchsorted(x_edges, right, "left")
+    first_y = numpy.searchsorted(y_edges, upper, "right") - 1
+    last_y = numpy.searchsorted(y_edges, lower, "left")
+
+    for y in range(first_y, last_y):
+        height = y_edges[y + 1] - y_edges[y]
+        if not height:
+            continue
+
+        row = keys[y].tolist()
+
+        for x in range(first_x, last_x):
+            width = x_edges[x + 1] - x_edges[x]
+            if not width:
+                continue
+
+            key = (row[x], width, height)
+            thumbnail = thumbnails.get(key)
+            if thumbnail is None:
+                thumbnail = _as_image(lookup(row[x]))
+                if thumbnail.size != (width, height):
+                    thumbnail = thumbnail.resize(
+                        (int(width), int(height)),
+                        Image.LANCZOS,
+                    )
+                thumbnails[key] = thumbnail
+
+            region.paste(
+                thumbnail,
+                (int(x_edges[x] - left), int(y_edges[y] - upper)),
+            )
+
+    return region
+
+
+def _overview(keys, lookup):
+    """Return an image with one pixel per cell of the mosaic, each the source
+    image downscaled to a single pixel.
+
+    :param keys: The keys of the cells' source images, as returned by
+        `_cell_keys`.
+    :param lookup: The function returning the source image for a key.
+    :returns: An image object.
+
+    """
+
+    # each distinct source image is only downscaled once
+    unique, cells = numpy.unique(keys, return_inverse=True)
+
+    pixels = numpy.zeros((len(unique), 3), dtype=numpy.uint8)
+    for i, key in enumerate(unique.tolist()):
+        pixels[i] = numpy.asarray(
+            _as_image(lookup(key)).resize((1, 1), Image.BOX)
+        )[0, 0]
+
+    overview = pixels[cells.reshape(keys.shape)]
+
+    return Image.fromarray(overview, "RGB")
+
+
+def write_deep_zoom(reference_image, tile_size, output_matrix, path,
+                    dzi_tile_size=254, overlap=1, format="jpeg", quality=90,
+                    registry=None):
+    """Write the output mosaic as a Deep Zoom image.
+
+    This writes the ``.dzi`` descriptor to `path` and the tiles of every level
+    to a ``_files`` directory next to it, as expected by viewers such as
+    OpenSeadragon.
+
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :param tile_size: How large each source image will be rendered in the final
+        output.
+    :param output_matrix: The output matrix, as for `output_from_matrix`.
+    :param path: The path of the ``.dzi`` file to write.
+    :param dzi_tile_size: The size of the pyramid's tiles, not counting overlap
+        (default: 254).
+    :param overlap: How many pixels each pyramid tile overlaps its neighbors
+        (default: 1).
+    :param format: The image format of the pyramid's tiles, "jpeg" or "png"
+        (default: "jpeg").
+    :param quality: The JPEG quality of the pyramid's tiles (default: 90).
+    :param registry: The `TileRegistry` the tile ids refer to. Required for an
+        array of tile ids.
+
+    """
+
+    width = tile_size * reference_image.width
+    height = tile_size * reference_image.height
+
+    base, _ = os.path.splitext(path)
+    files_directory = base + "_files"
+
+    max_level = int(math.ceil(math.log(max(width, height), 2)))
+
+    save_options = {}
+    if format == "jpeg":
+        save_options["quality"] = quality
+
+    keys, lookup = _cell_keys(output_matrix, registry)
+
+    overview = None
+
+    for level in range(max_level, -1, -1):
+
+        scale = 2 ** (max_level - level)
+
+        level_width = -(-width // scale)
+        level_height = -(-height // scale)
+
+        thumbnails = {}
+
+        if tile_size >= scale:
+            x_edges = _edges(reference_image.width, tile_size, scale)
+            y_edges = _edges(reference_image.height, tile_size, scale)
+
+            def render(box):
+                return _render_region(
+                    keys,
+                    lookup,
+                    x_edges,
+                    y_edges,
+                    box,
+                    thumbnails,
+                )
+        else:
+            # every cell is smaller than a pixel, so the whole level is no
+            # larger than the reference image and can be rendered at once by
+            # averaging one pixel per cell
+            if overview is None:
+                overview = _overview(keys, lookup)
+
+            # the level is rounded up to whole pixels, the mosaic itself only
+            # covers a fraction of the last one
+            content_size = (
+                max(1, int(round(width / float(scale)))),
+                max(1, int(round(height / float(scale)))),
+            )
+
+            level_image = Image.new("RGB", (level_width, level_height))
+            level_image.paste(overview.resize(content_size, Image.BOX), (0, 0))
+
+            def render(box):
+                return level_image.crop(box)
+
+        level_directory = os.path.join(files_directory, str(level))
+        if not os.path.isdir(level_directory):
+            os.makedirs(level_directory)
+
+        columns = -(-level_width // dzi_tile_size)
+        rows = -(-level_height // dzi_tile_size)
+
+        for column in range(columns):
+            for row in range(rows):
+
+                box = (
+                    max(column * dzi_tile_size - overlap, 0),
+                    max(row * dzi_tile_size - overlap, 0),
+                    min((column + 1) * dzi_tile_size + overlap, level_width),
+                    min((row + 1) * dzi_tile_size + overlap, level_height),
+                )
+
+                tile_path = os.path.join(
+                    level_directory,
+                    "{}_{}.{}".format(column, row, format),
+                )
+
+                render(box).save(tile_path, **save_options)
+
+    with open(path, "w") as fp:
+        fp.write(DZI_TEMPLATE.format(
+            format=format,
+            overlap=overlap,
+            tile_size=dzi_tile_size,
+            width=width,
+            height=height,
+        ))
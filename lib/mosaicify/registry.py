@@ -0,0 +1,256 @@
+# Copyright 2017, Ryan P. Kelly. All Rights Reserved.
+
+"""
+Integer-addressed storage for the tiles a mosaic is assembled from.
+"""
+
+from __future__ import absolute_import
+
+import random
+
+import numpy
+from PIL import Image
+
+
+class TileRegistry(object):
+    """The library of source images, each addressed by an integer tile id.
+
+    Tile ids are positions in the registry, so every other structure (indexes,
+    pools, output matrices) can refer to tiles by id instead of by holding and
+    comparing image objects.
+
+    """
+
+    def __init__(self, images, colors, paths=None):
+        """Create the registry.
+
+        :param images: A list of image objects, one per tile.
+        :param colors: A sequence of representative colors, one per tile.
+        :param paths: An optional list of the paths the tiles were loaded from.
+
+        """
+
+        if len(images) != len(colors):
+            raise ValueError("got {} images but {} colors".format(
+                len(images),
+                len(colors),
+            ))
+
+        if paths is not None and len(paths) != len(images):
+            raise ValueError("got {} images but {} paths".format(
+                len(images),
+                len(paths),
+            ))
+
+        self.images = list(images)
+        self.colors = numpy.array(colors, dtype=numpy.int64).reshape(
+            (len(self.images), -1)
+        )
+        self.paths = list(paths) if paths is not None else None
+
+        self._descriptors = {}
+
+    @classmethod
+    def from_sources(cls, source_images, paths=None):
+        """Create a registry from the list returned by `load_sources`.
+
+        :param source_images: A list of (image, representative color) tuples.
+        :param paths: An optional list of the paths the tiles were loaded from.
+        :returns: A new registry.
+
+        """
+
+        images = [image for image, _ in source_images]
+        colors = [rep_color for _, rep_color in source_images]
+
+        return cls(images, colors, paths=paths)
+
+    def __len__(self):
+        """Return the number of tiles."""
+
+        return len(self.images)
+
+    def image(self, tile_id):
+        """Return the image for a tile.
+
+        :param tile_id: The tile id.
+        :returns: An image object.
+
+        """
+
+        return self.images[tile_id]
+
+    def tile(self, tile_id):
+        """Return the pixels of a tile in whatever form is cheapest to paste
+        into the output.
+
+        :param tile_id: The tile id.
+        :returns: An image object, or an array of RGB pixels.
+
+        """
+
+        return self.images[tile_id]
+
+    def color(self, tile_id):
+        """Return the representative color of a tile.
+
+        :param tile_id: The tile id.
+        :returns: A three-tuple representing the color.
+
+        """
+
+        return tuple(self.colors[tile_id].tolist())
+
+    def _compute_descriptors(self, cells):
+        """Compute the descriptor of every tile, see `descriptors`.
+
+        :param cells: How many cells across each descriptor is.
+        :returns: An array of shape ``(tiles, cells * cells * 3)``.
+
+        """
+
+        descriptors = numpy.empty(
+            (len(self), cells * cells * 3),
+            dtype=numpy.int64,
+        )
+
+        for tile_id in range(len(self)):
+            image = self.image(tile_id).convert("RGB")
+            descriptors[tile_id] = numpy.asarray(
+                image.resize((cells, cells), Image.BOX)
+            ).ravel()
+
+        return descriptors
+
+    def descriptors(self, cells):
+        """Return a descriptor of every tile, made of the average colors of an
+        N by N grid of cells over the tile.
+
+        Descriptors are computed the first time they are asked for and then
+        kept.
+
+        :param cells: How many cells across each descriptor is.
+        :returns: An array of shape ``(tiles, cells * cells * 3)``, where each
+            row holds the cells' RGB colors in row-major order.
+
+        """
+
+        descriptors = self._descriptors.get(cells)
+        if descriptors is None:
+            descriptors = self._compute_descriptors(cells)
+            self._descriptors[cells] = descriptors
+
+        return descriptors
+
+    def path(self, tile_id):
+        """Return the path a tile was loaded from.
+
+        :param tile_id: The tile id.
+        :returns: The path, or `None` if it is not known.
+
+        """
+
+        if self.paths is None:
+            return None
+
+        return self.paths[tile_id]
+
+    def sources(self):
+        """Return the tiles in the format returned by `load_sources`.
+
+        :returns: A list of (image, representative color) tuples.
+
+        """
+
+        return [
+            (self.image(tile_id), self.color(tile_id))
+            for tile_id in range(len(self))
+        ]
+
+
+def as_registry(source_images):
+    """Return the given source images as a registry.
+
+    :param source_images: Either a `TileRegistry`, which is returned as is, or
+        a list as returned by `load_sources`.
+    :returns: A `TileRegistry`.
+
+    """
+
+    if isinstance(source_images, TileRegistry):
+        return source_images
+
+    return TileRegistry.from_sources(source_images)
+
+
+class TilePool(object):
+    """The set of tile ids not yet placed, kept as a swap-remove array so that
+    taking a tile, random or specific, and refilling the pool are O(1) per
+    tile.
+
+    """
+
+    def __init__(self, size):
+        """Create a full pool.
+
+        :param size: The number of tiles, ids run from 0 to ``size - 1``.
+
+        """
+
+        self._size = size
+        self.reset()
+
+    def __len__(self):
+        """Return the number of tiles still in the pool."""
+
+        return self._count
+
+    def __contains__(self, tile_id):
+        """Return whether a tile is still in the pool."""
+
+        return self._positions[tile_id] < self._count
+
+    def reset(self):
+        """Put every tile back into the pool."""
+
+        self._ids = list(range(self._size))
+        self._positions = list(range(self._size))
+        self._count = self._size
+
+    def remove(self, tile_id):
+        """Take a specific tile out of the pool.
+
+        :param tile_id: The tile id.
+
+        """
+
+        position = self._positions[tile_id]
+        if position >= self._count:
+            raise ValueError("tile {} is not in the pool".format(tile_id))
+
+        # swap the tile with the last one in the pool, then shrink the pool
+        last = self._count - 1
+        last_id = self._ids[last]
+
+        self._ids[position] = last_id
+        self._positions[last_id] = position
+
+        self._ids[last] = tile_id
+        self._positions[tile_id] = last
+
+        self._count = last
+
+    def take_random(self):
+        """Take a random tile out of the pool.
+
+        :returns: The tile id.
+
+        """
+
+        if not self._count:
+            raise IndexError("take from an empty pool")
+
+        tile_id = self._ids[random.randrange(self._count)]
+        self.remove(tile_id)
+
+        return tile_id
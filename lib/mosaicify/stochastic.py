@@ -2,158 +2,723 @@
 
 from __future__ import absolute_import
 
+import collections
+import copy
+import ctypes
+import math
+import multiprocessing
 import random
+import time
 
 import numpy
-import numpy.linalg
-from PIL import Image
 
 from mosaicify.output import output_from_matrix
+from mosaicify.pixels import match_points
+from mosaicify.registry import (
+    TilePool,
+    as_registry,
+)
 
 
-def _random_pixel(reference_image):
-    """Return a random pixel coordinate from the reference image.
+def _initial_placement(tile_count, cell_count):
+    """Randomly distribute tiles over the cells of the mosaic, using each tile
+    once before any is repeated.
 
-    :param reference_image: The image to return a random coordinate from.
-    :returns: A 2-tuple of the ranodm x, y coordinate.
+    :param tile_count: The number of tiles in the registry.
+    :param cell_count: The number of cells in the mosaic.
+    :returns: A list of tile ids, one per cell in row-major order.
 
     """
 
-    x = random.randint(0, reference_image.width - 1)
-    y = random.randint(0, reference_image.height - 1)
+    pool = TilePool(tile_count)
 
-    return (x, y)
+    placement = []
+    for _ in range(cell_count):
 
+        if not pool:
+            pool.reset()
 
-def _norm_for_source(reference_image, source, location):
-    """Return the norm for a source.
+        placement.append(pool.take_random())
 
-    :param reference_image: The image that is the source of the comparison
-        pixel.
-    :param source: A 2-tuple of source image and representative color.
-    :param location: A 2-tuple representing a position in the reference image.
-    :returns: The norm for the pixel given by location in the reference image
-        and source.
+    return placement
+
+
+def _cell_costs(reference, colors, placement):
+    """Return the distance between each cell's reference pixel and the
+    representative color of the tile placed there.
+
+    :param reference: An array of shape ``(cells, 3)`` of reference colors.
+    :param colors: An array of shape ``(tiles, 3)`` of representative colors.
+    :param placement: A sequence of tile ids, one per cell.
+    :returns: An array of distances, one per cell.
 
     """
 
-    pixel = reference_image.getpixel(location)
-    r = pixel[0]
-    g = pixel[1]
-    b = pixel[2]
-    reference_vec = numpy.array([[r, g, b]])
+    diff = reference - colors[numpy.asarray(placement)]
+
+    return numpy.sqrt(numpy.einsum("ij,ij->i", diff, diff))
 
-    _, rep_color = source
 
-    source_vec = numpy.array([rep_color])
-    norm = numpy.linalg.norm(reference_vec - source_vec)
+def _swap_sequential(reference, colors, placement, costs, generations,
+                     temperature=0):
+    """Randomly swap pairs of cells, keeping the swaps that lower the total
+    distance.
+
+    The cost of each cell is cached, so each generation only computes the two
+    distances the swap would produce, using plain Python arithmetic on
+    precomputed colors.
+
+    :param reference: A list of (r, g, b) reference colors, one per cell.
+    :param colors: A list of (r, g, b) representative colors, one per tile.
+    :param placement: A list of tile ids, one per cell. Updated in place.
+    :param costs: A list of the current cost of each cell. Updated in place.
+    :param generations: How many swaps to attempt.
+    :param temperature: If positive, also accept a swap that raises the total
+        distance by ``delta`` with probability ``exp(-delta / temperature)``
+        (default: 0).
+    :returns: A tuple of the number of swaps performed and the resulting change
+        in total distance.
+
+    """
 
-    return norm
+    cell_count = len(placement)
+    if cell_count < 2:
+        return (0, 0.0)
 
+    sqrt = math.sqrt
+    exp = math.exp
+    rand = random.random
 
-def _simplify_matrix(output_matrix):
+    accepted = 0
+    change = 0.0
+
+    for _ in range(generations):
+
+        # select two different random cells
+        i = int(rand() * cell_count)
+        j = int(rand() * (cell_count - 1))
+        if j >= i:
+            j += 1
+
+        tile_i = placement[i]
+        tile_j = placement[j]
+
+        r_i, g_i, b_i = reference[i]
+        r_j, g_j, b_j = reference[j]
+        c_r_i, c_g_i, c_b_i = colors[tile_i]
+        c_r_j, c_g_j, c_b_j = colors[tile_j]
+
+        swapped_i = sqrt(
+            (r_i - c_r_j)**2 + (g_i - c_g_j)**2 + (b_i - c_b_j)**2
+        )
+        swapped_j = sqrt(
+            (r_j - c_r_i)**2 + (g_j - c_g_i)**2 + (b_j - c_b_i)**2
+        )
 
-    """Simplify the matrix format used by this module's ``create_mosaic``
-    method into the matrix expected by the output image generation function.
+        delta = swapped_i + swapped_j - costs[i] - costs[j]
 
-    :param output_matrix: This module's matrix representation (each location is
-        an image, color tuple).
-    :returns: A new, simplified matrix.
+        # swapping is an improvement (or, when annealing, a lucky worsening),
+        # perform the swap
+        if delta < 0 or (temperature and rand() < exp(-delta / temperature)):
+
+            placement[i] = tile_j
+            placement[j] = tile_i
+            costs[i] = swapped_i
+            costs[j] = swapped_j
+
+            accepted += 1
+            change += delta
+
+    return (accepted, change)
+
+
+def _swap_batched(reference, colors, placement, costs, generations,
+                  batch_size, rng, temperature=0):
+    """Randomly swap pairs of cells, a batch of disjoint pairs at a time,
+    keeping the swaps that lower the total distance.
+
+    Every pair in a batch is evaluated in one vectorized pass. Because the
+    pairs share no cells, all of the accepted swaps can be applied together.
+
+    :param reference: An array of shape ``(cells, 3)`` of reference colors.
+    :param colors: An array of shape ``(tiles, 3)`` of representative colors.
+    :param placement: An array of tile ids, one per cell. Updated in place.
+    :param costs: An array of the current cost of each cell. Updated in place.
+    :param generations: How many swaps to attempt.
+    :param batch_size: How many swaps to attempt at once.
+    :param rng: The `numpy.random.Generator` to draw cells from.
+    :param temperature: If positive, also accept a swap that raises the total
+        distance by ``delta`` with probability ``exp(-delta / temperature)``
+        (default: 0).
+    :returns: A tuple of the number of swaps performed and the resulting change
+        in total distance.
 
     """
 
-    new_matrix = []
-    for row in output_matrix:
+    cell_count = len(placement)
 
-        new_row = []
-        for image, _ in row:
-            new_row.append(image)
+    # a batch can't pair up more cells than there are
+    batch_size = min(batch_size, cell_count // 2)
+    if batch_size < 1:
+        return (0, 0.0)
 
-        new_matrix.append(new_row)
+    accepted = 0
+    change = 0.0
+    attempted = 0
 
-    return new_matrix
+    while attempted < generations:
 
+        pairs = min(batch_size, generations - attempted)
+        attempted += pairs
 
-def create_mosaic(reference_image, source_images, tile_size, generations=1000000):
-    """Generate the output mosaic image by randomly distributing tile images and
-    then randomly swapping them if the swap improves the image.
+        cells = rng.choice(cell_count, 2 * pairs, replace=False)
+        cells_i = cells[:pairs]
+        cells_j = cells[pairs:]
 
-    :param reference_image: The image that is the source of pixels for the
-        output.
-    :param source_images: The list of images as returned by `load_sources` for
-        use as "pixels" of the output image.
-    :param tile_size: How large each source image will be rendered in the final
-        output.
-    :param generations: How many pixel-swapping attempts to perform (default:
-        100,000).
-    :returns: An image object.
+        tiles_i = placement[cells_i]
+        tiles_j = placement[cells_j]
+
+        diff_i = reference[cells_i] - colors[tiles_j]
+        diff_j = reference[cells_j] - colors[tiles_i]
+        swapped_i = numpy.sqrt(numpy.einsum("ij,ij->i", diff_i, diff_i))
+        swapped_j = numpy.sqrt(numpy.einsum("ij,ij->i", diff_j, diff_j))
+
+        delta = swapped_i + swapped_j - costs[cells_i] - costs[cells_j]
+
+        swap = delta < 0
+        if temperature:
+            chance = numpy.exp(-numpy.maximum(delta, 0) / temperature)
+            swap |= rng.random(pairs) < chance
+
+        cells_i = cells_i[swap]
+        cells_j = cells_j[swap]
+
+        placement[cells_i] = tiles_j[swap]
+        placement[cells_j] = tiles_i[swap]
+        costs[cells_i] = swapped_i[swap]
+        costs[cells_j] = swapped_j[swap]
+
+        accepted += len(cells_i)
+        change += float(delta[swap].sum())
+
+    return (accepted, change)
+
+
+# the arrays shared with worker processes, set up by `_init_worker`
+_shared = {}
+
+
+def _shared_array(values, ctype):
+    """Copy an array into memory that can be shared with worker processes.
+
+    :param values: The array to copy.
+    :param ctype: The ctypes type of the shared elements.
+    :returns: A tuple of the shared `multiprocessing.RawArray` and a NumPy
+        view of it with the same shape as `values`.
+
+    """
+
+    raw = multiprocessing.RawArray(ctype, values.size)
+
+    view = numpy.frombuffer(raw, dtype=numpy.dtype(ctype))
+    view = view.reshape(values.shape)
+    view[...] = values
+
+    return (raw, view)
+
+
+def _view(raw, ctype, shape):
+    """Return a NumPy view of an array made by `_shared_array`.
+
+    :param raw: The shared `multiprocessing.RawArray`.
+    :param ctype: The ctypes type of its elements.
+    :param shape: The shape of the view.
+    :returns: An array backed by the shared memory.
 
     """
 
-    pool = source_images[:]
+    return numpy.frombuffer(raw, dtype=numpy.dtype(ctype)).reshape(shape)
 
-    output_matrix = []
-    for _ in range(reference_image.height):
 
-        row = []
-        for _ in range(reference_image.width):
+def _init_worker(reference, colors, placement, costs, order, cell_count,
+                 tile_count):
+    """Set up a worker process for `_swap_region`.
 
-            if not pool:
-                pool = source_images[:]
+    :param reference: The shared reference colors.
+    :param colors: The shared representative colors.
+    :param placement: The shared tile ids, one per cell.
+    :param costs: The shared costs of each cell.
+    :param order: The shared shuffled cell indices the regions are cut from.
+    :param cell_count: The number of cells in the mosaic.
+    :param tile_count: The number of tiles in the registry.
 
-            source = random.choice(pool)
+    """
 
-            pool.remove(source)
+    _shared["reference"] = _view(reference, ctypes.c_double, (cell_count, 3))
+    _shared["colors"] = _view(colors, ctypes.c_double, (tile_count, 3))
+    _shared["placement"] = _view(placement, ctypes.c_int64, (cell_count,))
+    _shared["costs"] = _view(costs, ctypes.c_double, (cell_count,))
+    _shared["order"] = _view(order, ctypes.c_int64, (cell_count,))
 
-            row.append(source)
+    # for the sequential swaps, which are much faster on plain Python values
+    _shared["reference_tuples"] = [
+        tuple(color) for color in _shared["reference"].tolist()
+    ]
+    _shared["color_tuples"] = [
+        tuple(color) for color in _shared["colors"].tolist()
+    ]
 
-        output_matrix.append(row)
 
-    for _ in xrange(generations):
+def _swap_region(task):
+    """Swap pairs of cells within one region of the mosaic, in a worker
+    process.
 
-        # select two random pixels
-        loc_1 = _random_pixel(reference_image)
+    A region is a run of the shared, shuffled cell order. No other worker
+    touches the region's cells at the same time, so its tiles and costs are
+    gathered, swapped and then written back to the shared arrays.
 
-        while True:
-            loc_2 = _random_pixel(reference_image)
-            if loc_1 != loc_2:
-                break
+    :param task: A tuple of the first and last (exclusive) position of the
+        region in the cell order, how many swaps to attempt, the temperature,
+        the batch size (or None for sequential swaps) and a random seed.
+    :returns: A tuple of the number of swaps performed and the resulting change
+        in total distance.
+
+    """
 
-        # the output matrix is accessed by selecting a row (y) and then a
-        # position in that row (x)
-        source_1 = output_matrix[loc_1[1]][loc_1[0]]
-        source_2 = output_matrix[loc_2[1]][loc_2[0]]
+    start, stop, generations, temperature, batch_size, seed = task
 
-        current_norm_1 = _norm_for_source(
-            reference_image,
-            source_1,
-            loc_1,
+    cells = _shared["order"][start:stop]
+
+    placement = _shared["placement"][cells]
+    costs = _shared["costs"][cells]
+
+    if batch_size is not None:
+        result = _swap_batched(
+            _shared["reference"][cells],
+            _shared["colors"],
+            placement,
+            costs,
+            generations,
+            batch_size,
+            numpy.random.default_rng(seed),
+            temperature=temperature,
         )
-        current_norm_2 = _norm_for_source(
-            reference_image,
-            source_2,
-            loc_2,
+    else:
+        random.seed(seed)
+
+        reference_tuples = _shared["reference_tuples"]
+
+        region_placement = placement.tolist()
+        region_costs = costs.tolist()
+
+        result = _swap_sequential(
+            [reference_tuples[cell] for cell in cells.tolist()],
+            _shared["color_tuples"],
+            region_placement,
+            region_costs,
+            generations,
+            temperature=temperature,
         )
 
-        swapped_norm_1 = _norm_for_source(
-            reference_image,
-            source_2,
-            loc_1,
+        placement = region_placement
+        costs = region_costs
+
+    _shared["placement"][cells] = placement
+    _shared["costs"][cells] = costs
+
+    return result
+
+
+def _regions(cell_count, jobs):
+    """Split the cell order into runs of about equal size, one per job.
+
+    :param cell_count: The number of cells in the mosaic.
+    :param jobs: How many regions to make.
+    :returns: A list of (start, stop) ranges of positions in the cell order.
+
+    """
+
+    edges = numpy.unique(
+        numpy.round(numpy.linspace(0, cell_count, jobs + 1)).astype(int),
+    )
+
+    return list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+
+
+def _temperature(schedule, initial, final, progress):
+    """Return the annealing temperature part way through the optimization.
+
+    :param schedule: "exponential" or "linear".
+    :param initial: The temperature at the start.
+    :param final: The temperature at the end.
+    :param progress: How far through the generations the optimization is, from
+        0 to 1.
+    :returns: The temperature.
+
+    """
+
+    if schedule == "exponential":
+        return initial * (final / float(initial)) ** progress
+
+    if schedule == "linear":
+        return initial + (final - initial) * progress
+
+    raise ValueError("unknown temperature schedule '{}'".format(schedule))
+
+
+def create_matrix(reference_image, source_images, generations=1000000,
+                  batch_size=None, temperature=None, final_temperature=0.1,
+                  schedule="exponential", window=10000, tolerance=None,
+                  patience=10, time_limit=None, jobs=1, color_space="rgb",
+                  stats=None):
+    """Choose the source image for every pixel of the reference image by
+    randomly distributing tile images and then randomly swapping them if the
+    swap improves the image.
+
+    With a `temperature`, this performs simulated annealing instead: swaps
+    that make the image worse are sometimes accepted too, less and less often
+    as the temperature is lowered towards `final_temperature`, which lets the
+    search escape local minima. Annealing stops early once a whole `window` of
+    generations passes without accepting a swap, and the best placement seen
+    is returned.
+
+    The optimization can also stop early once it has converged, when the best
+    total distance improved by less than `tolerance` over the last `patience`
+    windows, or once `time_limit` seconds have passed.
+
+    With more than one of `jobs`, the cells are dealt out at random to one
+    region per worker process, and each worker swaps tiles within its region,
+    over arrays in shared memory. The cells are dealt out again every window,
+    so tiles move freely across the whole image.
+
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :param source_images: The list of images as returned by `load_sources`, or
+        a `TileRegistry`, for use as "pixels" of the output image.
+    :param generations: How many pixel-swapping attempts to perform (default:
+        1,000,000).
+    :param batch_size: If given, propose this many disjoint swaps at a time
+        and evaluate them together with NumPy, instead of one at a time
+        (default: None).
+    :param temperature: The starting temperature for simulated annealing, in
+        units of color distance. It must be positive. Use `None` to only
+        accept improving swaps (default: None).
+    :param final_temperature: The temperature reached at the last generation.
+        It can't be negative, and must be positive for the exponential
+        schedule (default: 0.1).
+    :param schedule: How the temperature falls, "exponential" or "linear"
+        (default: "exponential").
+    :param window: How many generations run between temperature updates and
+        convergence checks (default: 10,000).
+    :param tolerance: If given, stop once the best total distance improves by
+        less than this fraction over `patience` windows (default: None).
+    :param patience: How many windows the improvement is measured over
+        (default: 10).
+    :param time_limit: If given, stop after about this many seconds (default:
+        None).
+    :param jobs: How many worker processes to optimize with. Each window then
+        runs `window` generations per process, and at least one per cell
+        (default: 1).
+    :param color_space: The color space distances are measured in, "rgb" or
+        "lab" (default: "rgb").
+    :param stats: An optional dictionary, which is filled in with
+        "generations" (how many were run), "accepted", "acceptance_rate",
+        "elapsed", "generations_per_second", "cost" (the final total
+        distance), "stopped" (why the optimization ended: "generations",
+        "frozen", "converged" or "time_limit") and "history" (a list of
+        generations, total distance and acceptance rate tuples, one per
+        window).
+    :returns: An array of shape ``(height, width)`` of tile ids, as for
+        `mosaicify.create_matrix`.
+
+    """
+
+    if temperature is not None:
+        if temperature <= 0:
+            raise ValueError("the temperature must be positive")
+
+        if schedule == "exponential" and final_temperature <= 0:
+            raise ValueError(
+                "the final temperature of an exponential schedule must be "
+                "positive"
+            )
+
+        if final_temperature < 0:
+            raise ValueError("the final temperature can't be negative")
+
+    registry = as_registry(source_images)
+
+    width = reference_image.width
+    height = reference_image.height
+
+    colors, reference = match_points(
+        reference_image,
+        registry,
+        color_space=color_space,
+    )
+
+    cell_count = width * height
+    tile_count = len(registry)
+
+    placement = _initial_placement(tile_count, cell_count)
+
+    pool = None
+
+    if jobs > 1:
+        placement = numpy.array(placement, dtype=numpy.int64)
+        costs = _cell_costs(reference, colors, placement)
+
+        shared_reference, _ = _shared_array(reference, ctypes.c_double)
+        shared_colors, _ = _shared_array(colors, ctypes.c_double)
+        shared_placement, placement = _shared_array(placement, ctypes.c_int64)
+        shared_costs, costs = _shared_array(costs, ctypes.c_double)
+        shared_order, order = _shared_array(
+            numpy.arange(cell_count, dtype=numpy.int64),
+            ctypes.c_int64,
         )
-        swapped_norm_2 = _norm_for_source(
-            reference_image,
-            source_1,
-            loc_2,
+
+        pool = multiprocessing.Pool(
+            jobs,
+            initializer=_init_worker,
+            initargs=(
+                shared_reference,
+                shared_colors,
+                shared_placement,
+                shared_costs,
+                shared_order,
+                cell_count,
+                tile_count,
+            ),
         )
 
-        # swapping is an improvement, perform the swap
-        if swapped_norm_1 + swapped_norm_2 < current_norm_1 + current_norm_2:
+        regions = _regions(cell_count, jobs)
+
+        # seeded from the random module, so seeding it still makes runs
+        # repeatable
+        rng = numpy.random.default_rng(random.getrandbits(64))
+
+        # dealing out the cells and gathering a region's colors costs about
+        # as much as a swap per cell, so a window gives every worker at least
+        # as many swaps as its region has cells
+        window = max(window * jobs, cell_count)
+
+        def swap(count, temperature):
+            # every window the cells are dealt out to the regions afresh, so
+            # any two cells share a region as often as with a single process
+            order[:] = rng.permutation(cell_count)
+
+            tasks = []
+            for start, stop in regions:
+                tasks.append((
+                    start,
+                    stop,
+                    # share the generations out by region size, rounding so
+                    # that they still add up to `count`
+                    int(round(count * stop / float(cell_count)))
+                    - int(round(count * start / float(cell_count))),
+                    temperature,
+                    batch_size,
+                    random.getrandbits(64),
+                ))
+
+            results = pool.map(_swap_region, tasks)
+
+            return (
+                sum(result[0] for result in results),
+                sum(result[1] for result in results),
+            )
+    elif batch_size is None:
+        costs = _cell_costs(reference, colors, placement).tolist()
+
+        reference_tuples = [tuple(color) for color in reference.tolist()]
+        color_tuples = [tuple(color) for color in colors.tolist()]
+
+        def swap(count, temperature):
+            return _swap_sequential(
+                reference_tuples,
+                color_tuples,
+                placement,
+                costs,
+                count,
+                temperature=temperature,
+            )
+    else:
+        placement = numpy.array(placement, dtype=numpy.intp)
+        costs = _cell_costs(reference, colors, placement)
+
+        # seeded from the random module, so seeding it still makes runs
+        # repeatable
+        rng = numpy.random.default_rng(random.getrandbits(64))
+
+        def swap(count, temperature):
+            return _swap_batched(
+                reference,
+                colors,
+                placement,
+                costs,
+                count,
+                batch_size,
+                rng,
+                temperature=temperature,
+            )
+
+    annealing = temperature is not None
+
+    cost = float(sum(costs))
+    best_cost = cost
+    best_placement = None
+
+    # the best cost at the end of each of the last `patience` windows, to
+    # measure how much it has improved over a sliding window
+    recent_costs = collections.deque([cost], maxlen=patience + 1)
+    history = []
+
+    done = 0
+    accepted = 0
+    stopped = "generations"
+
+    start = time.time()
+
+    try:
+        while done < generations:
+
+            count = min(window, generations - done)
+
+            current_temperature = 0
+            if annealing:
+                current_temperature = _temperature(
+                    schedule,
+                    temperature,
+                    final_temperature,
+                    done / float(generations),
+                )
+
+            window_accepted, change = swap(count, current_temperature)
+
+            done += count
+            accepted += window_accepted
+            cost += change
+
+            if cost < best_cost:
+                best_cost = cost
+
+                # without annealing the cost never goes up, so the current
+                # placement is always the best one
+                if annealing:
+                    best_placement = copy.copy(placement)
+
+            recent_costs.append(best_cost)
+            history.append((done, cost, window_accepted / float(count)))
+
+            if annealing and not window_accepted:
+                stopped = "frozen"
+                break
+
+            full = len(recent_costs) == recent_costs.maxlen
+            if tolerance is not None and full:
+                oldest = recent_costs[0]
+                improvement = (oldest - best_cost) / oldest if oldest else 0
+                if improvement < tolerance:
+                    stopped = "converged"
+                    break
+
+            if time_limit is not None and time.time() - start >= time_limit:
+                stopped = "time_limit"
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = time.time() - start
+
+    if best_placement is not None and best_cost < cost:
+        placement = best_placement
+        cost = best_cost
+
+    placement = numpy.asarray(placement, dtype=numpy.int32)
+
+    if stats is not None:
+        stats.update({
+            "generations": done,
+            "accepted": accepted,
+            "acceptance_rate": accepted / float(done) if done else 0,
+            "elapsed": elapsed,
+            "generations_per_second": done / elapsed if elapsed else 0,
+            "cost": cost,
+            "stopped": stopped,
+            "history": history,
+        })
+
+    # the output matrix is accessed by selecting a row (y) and then a position
+    # in that row (x)
+    return placement.reshape((height, width))
+
+
+def create_mosaic(reference_image, source_images, tile_size, generations=1000000,
+                  batch_size=None, temperature=None, final_temperature=0.1,
+                  schedule="exponential", window=10000, tolerance=None,
+                  patience=10, time_limit=None, jobs=1, color_space="rgb",
+                  stats=None):
+    """Generate the output mosaic image by randomly distributing tile images and
+    then randomly swapping them if the swap improves the image.
+
+    :param reference_image: The image that is the source of pixels for the
+        output.
+    :param source_images: The list of images as returned by `load_sources`, or
+        a `TileRegistry`, for use as "pixels" of the output image.
+    :param tile_size: How large each source image will be rendered in the final
+        output.
+    :param generations: How many pixel-swapping attempts to perform (default:
+        1,000,000).
+    :param batch_size: If given, how many disjoint swaps to propose and
+        evaluate at a time (default: None).
+    :param temperature: If given, the starting temperature for simulated
+        annealing (default: None).
+    :param final_temperature: The temperature reached at the last generation
+        (default: 0.1).
+    :param schedule: How the temperature falls, "exponential" or "linear"
+        (default: "exponential").
+    :param window: How many generations run between temperature updates and
+        convergence checks (default: 10,000).
+    :param tolerance: If given, stop once the best total distance improves by
+        less than this fraction over `patience` windows (default: None).
+    :param patience: How many windows the improvement is measured over
+        (default: 10).
+    :param time_limit: If given, stop after about this many seconds (default:
+        None).
+    :param jobs: How many worker processes to optimize with (default: 1).
+    :param color_space: The color space distances are measured in, "rgb" or
+        "lab" (default: "rgb").
+    :param stats: An optional dictionary, which is filled in as described in
+        `create_matrix`.
+    :returns: An image object.
 
-            output_matrix[loc_1[1]][loc_1[0]] = source_2
-            output_matrix[loc_2[1]][loc_2[0]] = source_1
+    """
 
-    # simplify our output matrix a little so we can generate the output
-    new_matrix = _simplify_matrix(output_matrix)
+    registry = as_registry(source_images)
+
+    output_matrix = create_matrix(
+        reference_image,
+        registry,
+        generations=generations,
+        batch_size=batch_size,
+        temperature=temperature,
+        final_temperature=final_temperature,
+        schedule=schedule,
+        window=window,
+        tolerance=tolerance,
+        patience=patience,
+        time_limit=time_limit,
+        jobs=jobs,
+        color_space=color_space,
+        stats=stats,
+    )
 
     # create and return output
-    return output_from_matrix(reference_image, tile_size, new_matrix)
+    return output_from_matrix(
+        reference_image,
+        tile_size,
+        output_matrix,
+        registry=registry,
+    )
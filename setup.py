@@ -14,6 +14,8 @@ setup(
     url="http://blog.ryankelly.us/",
     scripts=[
         "scripts/mosaicify",
+        "scripts/mosaicify-atlas",
+        "scripts/mosaicify-render",
     ],
     install_requires=[
         "pillow",
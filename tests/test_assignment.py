@@ -0,0 +1,146 @@
+# Copyright 2017, Ryan P. Kelly. All Rights Reserved.
+
+from __future__ import absolute_import
+
+import itertools
+import random
+import unittest
+
+import numpy
+from PIL import Image
+
+from mosaicify.assignment import create_matrix
+
+
+def _case(width, height, tile_count, seed, spread=255):
+    """Make a reference image and source images with random colors.
+
+    :param width: The width of the reference image.
+    :param height: The height of the reference image.
+    :param tile_count: How many source images to make.
+    :param seed: The seed of the colors.
+    :param spread: How far the colors range from black (default: 255).
+    :returns: A tuple of the reference image, the source images as returned
+        by `load_sources` and the cost matrix of pixels by tiles.
+
+    """
+
+    rng = numpy.random.RandomState(seed)
+
+    pixels = rng.randint(0, spread + 1, size=(width * height, 3))
+    colors = rng.randint(0, spread + 1, size=(tile_count, 3))
+
+    reference_image = Image.new("RGB", (width, height))
+    reference_image.putdata([tuple(int(c) for c in p) for p in pixels])
+
+    source_images = [
+        (Image.new("RGB", (1, 1)), tuple(int(c) for c in color))
+        for color in colors
+    ]
+
+    diff = pixels[:, None].astype(numpy.float64) - colors[None]
+    costs = numpy.sqrt(numpy.sum(diff * diff, axis=-1))
+
+    return (reference_image, source_images, costs)
+
+
+def _cost(matrix, costs):
+    """Return the total cost of an output matrix."""
+
+    placement = matrix.ravel()
+
+    return costs[numpy.arange(len(placement)), placement].sum()
+
+
+class TestAssignment(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+
+    def check(self, matrix, costs, optimum):
+        placement = matrix.ravel()
+
+        # every tile is used at most once
+        self.assertEqual(len(set(placement.tolist())), len(placement))
+
+        # the default epsilon keeps the total within 1 of the optimum
+        self.assertLessEqual(_cost(matrix, costs), optimum + 1.0)
+
+    def test_brute_force(self):
+        for seed in range(6):
+            reference_image, source_images, costs = _case(3, 2, 8, seed)
+
+            optimum = min(
+                costs[numpy.arange(6), list(tiles)].sum()
+                for tiles in itertools.permutations(range(8), 6)
+            )
+
+            matrix = create_matrix(
+                reference_image,
+                source_images,
+                candidates=2,
+            )
+
+            self.assertEqual(matrix.shape, (2, 3))
+            self.check(matrix, costs, optimum)
+
+    def test_contested(self):
+        # every pixel wants the same few tiles, so one candidate each is far
+        # from enough and the candidates have to be widened
+        reference_image, _, _ = _case(3, 2, 0, 1, spread=10)
+        _, source_images, _ = _case(1, 1, 8, 2)
+
+        # only two tiles are near the reference at all
+        for i in range(2):
+            source_images[i] = (Image.new("RGB", (1, 1)), (i, i, i))
+
+        pixels = numpy.asarray(reference_image).reshape((-1, 3))
+        colors = numpy.array([color for _, color in source_images])
+        diff = pixels[:, None].astype(numpy.float64) - colors[None]
+        costs = numpy.sqrt(numpy.sum(diff * diff, axis=-1))
+
+        optimum = min(
+            costs[numpy.arange(6), list(tiles)].sum()
+            for tiles in itertools.permutations(range(8), 6)
+        )
+
+        stats = {}
+        matrix = create_matrix(
+            reference_image,
+            source_images,
+            candidates=1,
+            stats=stats,
+        )
+
+        self.check(matrix, costs, optimum)
+        self.assertGreater(stats["solves"], 1)
+
+    def test_scipy(self):
+        try:
+            from scipy.optimize import linear_sum_assignment
+        except ImportError:
+            raise unittest.SkipTest("scipy is not installed")
+
+        for width, height, tile_count in ((10, 8, 80), (12, 10, 200)):
+            reference_image, source_images, costs = _case(
+                width,
+                height,
+                tile_count,
+                width,
+            )
+
+            rows, tiles = linear_sum_assignment(costs)
+
+            matrix = create_matrix(reference_image, source_images)
+
+            self.check(matrix, costs, costs[rows, tiles].sum())
+
+    def test_too_few_tiles(self):
+        reference_image, source_images, _ = _case(3, 2, 5, 0)
+
+        with self.assertRaises(ValueError):
+            create_matrix(reference_image, source_images)
+
+
+if __name__ == "__main__":
+    unittest.main()